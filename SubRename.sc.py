@@ -1,8 +1,42 @@
 # -*- coding: utf-8 -*-
+import argparse
+import atexit
+import codecs
+import collections
+import contextlib
+import fnmatch
+import json
+import logging
+import logging.handlers
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import select
 import shutil
+import socket
+import struct
 import sys
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+try:
+    import curses
+except ImportError: # Not included with the standard Windows Python
+    curses = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = tty = None
 
 # --- ANSI Color Codes ---
 COLOR_RED = '\033[91m'
@@ -48,33 +82,873 @@ CONFIG = {
     # 开启sp模式将跳过格式提醒，自动进入基于每集视频文件命名，处理每集有不同文件名的模式
     # 1 = 开启sp模式, None = 不开启sp模式
     "FORCE_SP_MODE": None,
+
+    # 预设 是否识别字幕内容的语言（文件名中没有语言缩写时，读取字幕开头几KB内容判断简体/繁体中文、日语、韩语或英语）
+    # 1 = 是, None = 否
+    "SNIFF_CONTENT_LANGUAGE": None,
+
+    # 在文件名中查找语言代码的位置，越靠前优先级越高：
+    # "suffix" = 扩展名之前 (Show 01.en.ass)，"bracket" = 整个方括号 ([CHS], [简繁], [CHS_JPN])，
+    # "delimited" = 紧挨扩展名或集数、由 _ . 或 - 分隔的代码 (Show_01_eng.ass；至少 3 个字母)。
+    # 例如：["suffix", "bracket", "delimited"] 同时识别方括号和分隔符中的代码。
+    # 设置为 None 则只使用扩展名前的代码。
+    "LANGUAGE_TAG_PRECEDENCE": None,
+
+    # 预设 是否在复制时将字幕文件（GBK、Big5、Shift-JIS等）转换为 UTF-8 编码
+    # 1 = 是, None = 否（按原样复制）
+    "CONVERT_TO_UTF8": None,
+
+    # 预设 转换后的文件是否带 BOM
+    # 1 = 不带 BOM, 2 = 带 BOM, None = 与原文件保持一致
+    "OUTPUT_BOM": None,
+
+    # 预设 转换后文件的换行符
+    # "crlf" = Windows, "lf" = Unix, None = 保持原换行符
+    "OUTPUT_LINE_ENDING": None,
+
+    # 预设 sp模式下是否使用文件名中的发布CRC32（如 '[ABCD1234]'）匹配字幕与视频
+    # 1 = 按CRC32标签匹配, 2 = 匹配并校验视频文件的CRC32, None = 不使用
+    "SP_CRC32_MODE": None,
+
+    # 预设 扫描文件夹时不进入的文件夹名称（支持通配符）
+    # 示例: [".git", "Extras", "Scans", "Menus"]
+    # 设置为 None 则进入所有文件夹
+    "SCAN_PRUNE_DIRS": [".git", ".svn", ".hg", "@eaDir", "$RECYCLE.BIN", "System Volume Information"],
+
+    # 预设 从拖入的字幕文件夹中只收集名称匹配以下规则的文件（支持通配符）
+    # 示例: ["*.ass", "*.ssa", "*.srt", "*.vtt", "*.sup", "*.zip", "*.7z", "*.rar"]
+    # 设置为 None 则收集所有文件
+    "SCAN_INCLUDE": None,
+
+    # 预设 扫描文件夹时跳过名称匹配以下规则的文件（支持通配符）
+    # 示例: ["*.nfo", "*.jpg", "*.png", "*.txt"]
+    # 设置为 None 则不跳过任何文件
+    "SCAN_EXCLUDE": None,
+
+    # 预设 是否记住每个系列的选择（语言、后缀、目标格式、sp模式视频文件夹、保存/删除/归档/字体选项）
+    # 下次从同一文件夹拖入同一系列的字幕时直接沿用，跳过这些询问
+    # 1 = 是, None = 否
+    "USE_SERIES_PROFILES": None,
+
+    # 预设 是否使用全屏终端界面（输入、分组、处理计划和进度窗格）
+    # 需要 'curses' 模块（Windows 下: pip install windows-curses），否则使用普通控制台
+    # 1 = 是, None = 否
+    "USE_CURSES_UI": None,
+
+    # 将每个文件操作（复制、删除、匹配、错误）写入日志文件，文件过大时自动轮换
+    # 控制台只显示逐个文件消息的汇总
+    # 示例: "~/.subrename/subrename.log"
+    # 设置为 None 则不保存日志文件
+    "LOG_FILE": None,
+
+    # 为其他程序输出机器可读的事件流：每行一个 JSON 对象，包括扫描进度、识别到的分组、
+    # 处理计划条目、文件操作和各阶段耗时
+    # "fd:3" = 已打开的文件描述符, "tcp:host:port" 或 "unix:/path" = 套接字, 其他内容 = 文件路径
+    # 设置为 None 则不输出事件
+    "EVENT_STREAM": None,
+
+    # 程序退出时将运行统计（扫描和重命名的文件数、未匹配的字幕、复制的字节数、字体、错误、
+    # 各阶段耗时）写入此文件，供 node_exporter 的 textfile collector 读取，计数会在多次运行间累加
+    # 示例: "/var/lib/node_exporter/textfile_collector/subrename.prom"
+    # 设置为 None 则不写入统计
+    "METRICS_FILE": None,
 }
+# 以上设置也可以不修改代码：写在 JSON 格式的用户配置文件中（~/.subrename/config.json，
+# 或环境变量 SUBRENAME_CONFIG 指定的路径），或写在任意文件夹下 JSON 格式的 '.subrename' 文件中，
+# 对该文件夹及其子文件夹生效（离得最近的文件优先）。示例: {"PRESET_LANGUAGE": ["sc"], "PRESET_SAVE_LOCATION": 1}
 # ==============================================================================
 # ================================ 预设区结束 ===================================
 # ==============================================================================
 
 
+# --- Terminal interface ---
+ANSI_COLOR_PATTERN = re.compile(r'\033\[(\d+)m')
+# Lines kept in the message pane of the curses interface.
+UI_LOG_LINES = 2000
+# Minimum seconds between two redraws caused by output or progress alone.
+UI_REDRAW_INTERVAL = 0.1
+
+# The running CursesUI, or None on the plain console.
+_ui = None
+
+def enable_ansi_colors():
+    """Turns on ANSI escape processing in the Windows console, without spawning a shell."""
+    if sys.platform != "win32":
+        return
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11) # STD_OUTPUT_HANDLE
+        mode = ctypes.c_uint32()
+        if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            kernel32.SetConsoleMode(handle, mode.value | 0x0004) # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+    except (AttributeError, OSError):
+        pass
+
 def clear_screen():
-    """Clears the terminal screen."""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    """Clears the terminal screen (the message pane in the curses interface)."""
+    flush_log()
+    if _ui:
+        _ui.clear_log()
+    else:
+        sys.stdout.write('\033[2J\033[H')
+        sys.stdout.flush()
+
+def read_line(prompt=''):
+    """input() that reads from the curses interface while it is running."""
+    flush_log()
+    return _ui.read_line(prompt) if _ui else input(prompt)
+
+def set_ui_pane(name, lines):
+    """Replaces the contents of a curses pane ('inputs', 'groups' or 'plan'). No-op on the plain console."""
+    if _ui:
+        _ui.set_pane(name, lines)
+
+def report_progress(done, total, label):
+    """Shows progress of a long loop in the curses interface. No-op on the plain console."""
+    if _ui:
+        _ui.set_progress(done, total, label)
+
+def _char_width(char):
+    return 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+
+def _fit_to_width(text, width, keep_end=False):
+    """text cut to at most `width` terminal columns (CJK characters take two); keep_end keeps the tail."""
+    chars = reversed(text) if keep_end else text
+    kept, used = [], 0
+    for char in chars:
+        used += _char_width(char)
+        if used > width:
+            break
+        kept.append(char)
+    return ''.join(reversed(kept) if keep_end else kept)
+
+class CursesUI:
+    """
+    Full-screen interface: input, group and plan panes on top, a scrolling message pane that
+    receives everything printed, a progress line and an input line. Only panes whose content
+    changed are redrawn, and curses only sends the changed cells to the terminal.
+    """
+    PANES = (('inputs', "输入"), ('groups', "识别到的分组"), ('plan', "处理计划"))
+
+    def __init__(self, screen, title):
+        self.screen = screen
+        self.title = title
+        self.panes = {name: [] for name, _ in self.PANES}
+        self.log = collections.deque(maxlen=UI_LOG_LINES)
+        self.partial_line = ''
+        self.progress = ''
+        self.last_redraw = 0.0
+        self.colors = {}
+        try:
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_RED, -1)
+            curses.init_pair(2, curses.COLOR_GREEN, -1)
+            self.colors = {'91': curses.color_pair(1), '92': curses.color_pair(2)}
+        except curses.error:
+            pass # Monochrome terminal
+        self.layout()
+
+    def layout(self):
+        """Creates the pane windows for the current terminal size."""
+        height, width = self.screen.getmaxyx()
+        height, width = max(height, 8), max(width, 30)
+        pane_height = max(3, min(10, (height - 4) // 3))
+        column_width = width // len(self.PANES)
+        self.windows = {}
+        for index, (name, _) in enumerate(self.PANES):
+            pane_width = column_width if index < len(self.PANES) - 1 else width - column_width * index
+            self.windows[name] = curses.newwin(pane_height, pane_width, 1, column_width * index)
+        self.windows['log'] = curses.newwin(max(1, height - pane_height - 3), width, pane_height + 1, 0)
+        self.windows['progress'] = curses.newwin(1, width, height - 2, 0)
+        self.windows['input'] = curses.newwin(1, width, height - 1, 0)
+        self.windows['input'].keypad(True)
+        self.screen.erase()
+        self.screen.noutrefresh()
+        self.dirty = {'title', 'log', 'progress'} | set(self.panes)
+        self.redraw(force=True)
+
+    def _add_text(self, window, y, x, text, width):
+        """Draws one line, turning the script's ANSI color codes into curses attributes."""
+        attr = curses.A_NORMAL
+        for index, part in enumerate(ANSI_COLOR_PATTERN.split(text)):
+            if index % 2:
+                attr = self.colors.get(part, curses.A_NORMAL)
+                continue
+            part = _fit_to_width(part.replace('\t', '    '), width - x)
+            if not part:
+                continue
+            try:
+                window.addstr(y, x, part, attr)
+            except curses.error:
+                pass # Writing the bottom-right cell raises, but still draws
+            x += sum(_char_width(char) for char in part)
+
+    def _draw(self, name):
+        if name == 'title':
+            width = self.screen.getmaxyx()[1]
+            self.screen.move(0, 0)
+            self.screen.clrtoeol()
+            self._add_text(self.screen, 0, 0, f" {self.title}", width)
+            self.screen.chgat(0, 0, -1, curses.A_REVERSE)
+            self.screen.noutrefresh()
+            return
+        window = self.windows[name]
+        height, width = window.getmaxyx()
+        window.erase()
+        if name == 'log':
+            for y, line in enumerate(list(self.log)[-height:]):
+                self._add_text(window, y, 0, line, width)
+        elif name == 'progress':
+            self._add_text(window, 0, 0, self.progress, width)
+        else:
+            window.box()
+            self._add_text(window, 0, 2, f" {dict(self.PANES)[name]} ", width - 2)
+            lines = self.panes[name]
+            visible = height - 2
+            if len(lines) > visible:
+                lines = lines[:visible - 1] + [f"... 还有 {len(lines) - visible + 1} 项"]
+            for y, line in enumerate(lines):
+                self._add_text(window, y + 1, 1, line, width - 1)
+        window.noutrefresh()
+
+    def redraw(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_redraw < UI_REDRAW_INTERVAL:
+            return
+        self.last_redraw = now
+        for name in self.dirty:
+            self._draw(name)
+        self.dirty.clear()
+        curses.doupdate()
+
+    # File-like interface, so print() writes into the message pane.
+    def write(self, text):
+        lines = (self.partial_line + text).split('\n')
+        self.partial_line = lines.pop()
+        if lines:
+            self.log.extend(lines)
+            self.dirty.add('log')
+            self.redraw()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def clear_log(self):
+        self.log.clear()
+        self.partial_line = ''
+        self.dirty.add('log')
+
+    def set_pane(self, name, lines):
+        self.panes[name] = [str(line) for line in lines]
+        self.dirty.add(name)
+        self.redraw(force=True)
+
+    def set_progress(self, done, total, label):
+        if done < total and time.monotonic() - self.last_redraw < UI_REDRAW_INTERVAL:
+            return
+        width = max(10, self.windows['progress'].getmaxyx()[1] // 3)
+        filled = width * done // total if total else width
+        self.progress = f"{label}: [{'#' * filled}{'.' * (width - filled)}] {done}/{total}"
+        self.dirty.add('progress')
+        self.redraw(force=True)
+
+    def read_line(self, prompt='', on_change=None):
+        """
+        Line editor on the input line; the prompt and answer are echoed to the message pane.
+        on_change(text) is called after every edit.
+        """
+        # Text printed without a newline right before input() is part of the prompt.
+        prompt = ANSI_COLOR_PATTERN.sub('', self.partial_line + prompt).lstrip('\n')
+        self.partial_line = ''
+        window = self.windows['input']
+        text = ''
+        self.redraw(force=True)
+        while True:
+            width = window.getmaxyx()[1] - 1
+            window.erase()
+            line = prompt + text
+            if sum(_char_width(char) for char in line) > width:
+                line = _fit_to_width(line, width, keep_end=True)
+            self._add_text(window, 0, 0, line, width + 1)
+            window.noutrefresh()
+            curses.doupdate()
+            try:
+                key = window.get_wch()
+            except curses.error:
+                continue
+            if key == curses.KEY_RESIZE:
+                self.layout()
+                window = self.windows['input']
+            elif key in ('\n', '\r', curses.KEY_ENTER):
+                break
+            elif key in ('\b', '\x7f', curses.KEY_BACKSPACE):
+                text = text[:-1]
+            elif key == '\x04' and not text:
+                raise EOFError
+            elif isinstance(key, str) and key.isprintable():
+                text += key
+            else:
+                continue
+            if on_change:
+                on_change(text)
+        self.log.append(prompt + text)
+        self.dirty.add('log')
+        return text
+
+def _read_console_keys():
+    """
+    Yields the text typed on the console, one chunk per read, with Enter as '\n' and
+    Backspace as '\b'. A pasted path arrives as a single chunk. Arrow and other special
+    keys are dropped.
+    """
+    if msvcrt:
+        while True:
+            chunk = ''
+            while True:
+                char = msvcrt.getwch()
+                if char in ('\x00', '\xe0'):
+                    msvcrt.getwch() # Second half of a special key
+                elif char == '\x03':
+                    raise KeyboardInterrupt
+                else:
+                    chunk += '\n' if char == '\r' else char
+                if not msvcrt.kbhit():
+                    break
+            yield chunk
+    else:
+        fd = sys.stdin.fileno()
+        decoder = codecs.getincrementaldecoder(sys.stdin.encoding or 'utf-8')(errors='replace')
+        while True:
+            chunk = decoder.decode(os.read(fd, 4096))
+            chunk = re.sub(r'\x1b(?:\[[0-9;?]*[ -/]*[@-~]|O.)?', '', chunk)
+            yield chunk.replace('\r', '\n').replace('\x7f', '\b')
+
+def read_line_with_preview(prompt, render_preview):
+    """
+    read_line() that shows render_preview(text) below the input and updates it after every
+    keystroke. Falls back to a plain read_line() when the console can't be read key by key.
+    """
+    flush_log()
+    if _ui:
+        return _ui.read_line(prompt, on_change=lambda text: _ui.set_pane('plan', render_preview(text)))
+    if not (sys.stdin.isatty() and sys.stdout.isatty()) or not (msvcrt or termios):
+        return read_line(prompt)
+
+    text = ''
+    input_rows = 1
+    def render(final=False):
+        nonlocal input_rows
+        columns = max(20, shutil.get_terminal_size().columns)
+        line = prompt + text
+        # Back to the start of the input line, then clear it and the old preview.
+        output = '\r' + (f'\033[{input_rows - 1}A' if input_rows > 1 else '') + '\033[J' + line
+        line_width = sum(_char_width(char) for char in line)
+        input_rows = line_width // columns + 1
+        if final:
+            sys.stdout.write(output + '\n')
+            sys.stdout.flush()
+            return
+        preview = [_fit_to_width(preview_line, columns - 1) for preview_line in render_preview(text)]
+        for preview_line in preview:
+            output += '\n' + preview_line + COLOR_RESET
+        if preview:
+            output += f'\033[{len(preview)}A'
+        output += '\r' + (f'\033[{line_width % columns}C' if line_width % columns else '')
+        sys.stdout.write(output)
+        sys.stdout.flush()
+
+    with _cbreak_console():
+        render()
+        for chunk in _read_console_keys():
+            done = False
+            for char in chunk:
+                if char == '\n':
+                    done = True
+                    break
+                if char == '\b':
+                    text = text[:-1]
+                elif char == '\x04' and not text:
+                    raise EOFError
+                elif char.isprintable():
+                    text += char
+            if done:
+                render(final=True)
+                return text
+            render()
+
+@contextlib.contextmanager
+def _cbreak_console():
+    """Key-by-key input on a POSIX terminal; the previous terminal mode is restored on exit."""
+    if msvcrt:
+        yield # msvcrt reads keys directly
+        return
+    fd = sys.stdin.fileno()
+    old_mode = termios.tcgetattr(fd)
+    tty.setcbreak(fd)
+    try:
+        yield
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old_mode)
+
+def run_with_curses_ui(main_function, title):
+    """Runs main_function inside the curses interface, with printed output sent to its message pane."""
+    global _ui
+    log = []
+    def session(screen):
+        global _ui
+        _ui = CursesUI(screen, title)
+        stdout = sys.stdout
+        sys.stdout = _ui
+        try:
+            main_function()
+        finally:
+            flush_log()
+            sys.stdout = stdout
+            log.extend(_ui.log)
+            _ui = None
+    try:
+        curses.wrapper(session)
+    finally:
+        _ui = None
+        # Keep the last messages (e.g. the final report) visible after the screen is restored.
+        for line in log[-20:]:
+            print(line)
+
+# --- Logging ---
+# Level of the green "Successfully ..." messages, between INFO and WARNING.
+LOG_SUCCESS = 25
+logging.addLevelName(LOG_SUCCESS, 'SUCCESS')
+LOG_LEVEL_COLORS = {LOG_SUCCESS: COLOR_GREEN, logging.WARNING: COLOR_RED, logging.ERROR: COLOR_RED}
+# Console lines buffered before they are written out in one go.
+LOG_BUFFER_LINES = 50
+# Seconds between two "... so far" summaries of a long per-file operation.
+LOG_SUMMARY_INTERVAL = 2.0
+# Per-file warnings and errors shown on the console for each operation; the rest are only counted.
+LOG_CONSOLE_DETAIL_LIMIT = 10
+LOG_FILE_MAX_BYTES = 1 << 20
+LOG_FILE_BACKUPS = 3
+LOG_FILE_FORMAT = '%(asctime)s %(levelname)-7s %(message)s'
+# Names of the per-file operations in console summaries.
+FILE_OPERATION_LABELS = {
+    'copy': "复制",
+    'delete': "删除",
+    'fonts': "字体",
+    'archive': "未处理的文件",
+    'match': "SP模式匹配",
+}
+
+class ConsoleLogHandler(logging.Handler):
+    """
+    Buffered console output for the log. Records logged with a file_op (one per file, see
+    log_file_event) are coalesced: successes are only counted, the first few warnings and
+    errors of each operation are shown, and a long operation prints a summary every few
+    seconds. Other records are written right away, after the pending lines.
+    Lines go to the current sys.stdout, so the curses interface receives them too.
+    """
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.pending = []
+        self.tallies = collections.OrderedDict() # file_op -> Counter of 'files', 'problems', 'shown'
+        self.last_summary = time.monotonic()
+        self.log_path = None
+
+    def _line(self, record):
+        color = LOG_LEVEL_COLORS.get(record.levelno)
+        prefix = "\n" if getattr(record, 'blank_line', False) else ""
+        return f"{prefix}{color}{record.getMessage()}{COLOR_RESET}" if color else prefix + record.getMessage()
+
+    def emit(self, record):
+        try:
+            file_op = getattr(record, 'file_op', None)
+            if file_op is None:
+                self._close_operations()
+                self.pending.append(self._line(record))
+                self._write()
+                return
+            tally = self.tallies.setdefault(file_op, collections.Counter())
+            tally['files'] += 1
+            if record.levelno >= logging.WARNING:
+                tally['problems'] += 1
+                if tally['shown'] < LOG_CONSOLE_DETAIL_LIMIT:
+                    tally['shown'] += 1
+                    self.pending.append(self._line(record))
+            if time.monotonic() - self.last_summary >= LOG_SUMMARY_INTERVAL:
+                for op, op_tally in self.tallies.items():
+                    problems = f"，{op_tally['problems']} 个问题" if op_tally['problems'] else ""
+                    self.pending.append(f"{FILE_OPERATION_LABELS.get(op, op)}: 已处理 {op_tally['files']} 个文件{problems}")
+                self._write()
+            elif len(self.pending) >= LOG_BUFFER_LINES:
+                self._write()
+        except Exception:
+            self.handleError(record)
+
+    def _close_operations(self):
+        """Ends the current per-file operations, noting the warnings and errors that were not shown."""
+        for op, tally in self.tallies.items():
+            hidden = tally['problems'] - tally['shown']
+            if hidden:
+                where = f"（详见 {self.log_path}）" if self.log_path else ""
+                self.pending.append(f"{COLOR_RED}{FILE_OPERATION_LABELS.get(op, op)}: 另有 {hidden} 个问题未显示{where}{COLOR_RESET}")
+        self.tallies.clear()
+
+    def _write(self):
+        self.last_summary = time.monotonic()
+        if self.pending:
+            sys.stdout.write('\n'.join(self.pending) + '\n')
+            sys.stdout.flush()
+            self.pending = []
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._close_operations()
+            self._write()
+        finally:
+            self.release()
+
+logger = logging.getLogger('subrename')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_console_log = ConsoleLogHandler()
+logger.addHandler(_console_log)
+
+def log_file_event(file_op, level, message, *args, **event_fields):
+    """
+    Logs the outcome of one file of a bulk operation (a key of FILE_OPERATION_LABELS) and
+    sends it to the event stream as file_done, file_warning or file_failed with event_fields.
+    """
+    logger.log(level, message, *args, extra={'file_op': file_op})
+    if level >= logging.ERROR:
+        count_metric('subrename_errors_total', op=file_op)
+    if _event_stream:
+        event = 'file_failed' if level >= logging.ERROR else 'file_warning' if level >= logging.WARNING else 'file_done'
+        emit_event(event, op=file_op, message=message % args if args else message, **event_fields)
+
+def flush_log():
+    """Writes out the buffered console lines, e.g. before a prompt or when an operation is done."""
+    _console_log.flush()
+
+def enable_log_file():
+    """Adds the rotating LOG_FILE, which receives every record including the per-file ones."""
+    log_file = CONFIG.get("LOG_FILE")
+    if not log_file:
+        return
+    path = os.path.abspath(os.path.expanduser(str(log_file)))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_MAX_BYTES,
+                                                       backupCount=LOG_FILE_BACKUPS, encoding='utf-8')
+    except OSError as e:
+        print(f"{COLOR_RED}警告：无法打开日志文件 '{path}': {e}{COLOR_RESET}")
+        return
+    handler.setFormatter(logging.Formatter(LOG_FILE_FORMAT))
+    logger.addHandler(handler)
+    _console_log.log_path = path
+
+# --- Event stream ---
+# Events: stage_started/stage_finished (stage, seconds), scan_progress, group_detected,
+# plan_entry, file_done/file_warning/file_failed (op, message, source, target, error)
+# and dropped (count). Every event has 'event' and 'time' (Unix time) fields.
+# Events waiting to be written; when the queue is full, new events are dropped and counted.
+EVENT_QUEUE_SIZE = 10000
+# Progress events are already dropped when the queue is this full, keeping room for the others.
+EVENT_PROGRESS_HIGH_WATER = EVENT_QUEUE_SIZE // 2
+EVENT_PROGRESS_TYPES = {'scan_progress'}
+# Events joined into one write.
+EVENT_BATCH_SIZE = 256
+# Seconds to wait at exit for the queued events to be written.
+EVENT_CLOSE_TIMEOUT = 5.0
+# Seconds to wait for a tcp: or unix: event stream to accept the connection.
+EVENT_CONNECT_TIMEOUT = 5.0
+
+def _write_fd(fd, data):
+    """
+    Writes all of data to fd. A non-blocking fd that is full raises BlockingIOError if nothing
+    was written yet; once part of a batch is out, the rest is waited for to keep lines whole.
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            if len(view) == len(data):
+                raise
+            select.select([], [fd], [])
+
+class EventStream:
+    """
+    Writes events as NDJSON from a background thread, so a slow reader never stalls the
+    renaming. emit() never blocks: progress events are dropped once the queue is half full
+    and other events when it is full; the number dropped is reported in a 'dropped' event.
+    """
+    def __init__(self, write, close):
+        self._write = write
+        self._close = close
+        self.queue = queue.Queue(EVENT_QUEUE_SIZE)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.broken = False
+        self.thread = threading.Thread(target=self._run, name='event-stream', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def open(cls, target):
+        """Connects to 'fd:N', 'tcp:host:port', 'unix:/path' or a file path (appended to)."""
+        kind, _, address = target.partition(':')
+        if kind == 'fd' and address.isdigit():
+            fd = int(address)
+            return cls(lambda data: _write_fd(fd, data), lambda: None)
+        if kind == 'tcp':
+            host, _, port = address.rpartition(':')
+            sock = socket.create_connection((host, int(port)), timeout=EVENT_CONNECT_TIMEOUT)
+        elif kind == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(EVENT_CONNECT_TIMEOUT)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            stream = open(os.path.expanduser(target), 'ab')
+            def write(data):
+                stream.write(data)
+                stream.flush()
+            return cls(write, stream.close)
+        # The timeout is only for connecting; the writer thread may block on a slow reader.
+        sock.settimeout(None)
+        return cls(sock.sendall, sock.close)
+
+    def emit(self, event, fields):
+        if self.broken:
+            return
+        item = {'event': event, 'time': round(time.time(), 3)}
+        item.update(fields)
+        if event in EVENT_PROGRESS_TYPES and self.queue.qsize() >= EVENT_PROGRESS_HIGH_WATER:
+            self._drop()
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self._drop()
+
+    def _drop(self):
+        with self.dropped_lock:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            events = [self.queue.get()]
+            while len(events) < EVENT_BATCH_SIZE:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [json.dumps(event, ensure_ascii=False, default=str) for event in events if event is not None]
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(json.dumps({'event': 'dropped', 'time': round(time.time(), 3), 'count': dropped}))
+            try:
+                if lines:
+                    self._write(('\n'.join(lines) + '\n').encode('utf-8'))
+            except BlockingIOError:
+                # A non-blocking reader is full: drop this batch and count it, like a full queue.
+                with self.dropped_lock:
+                    self.dropped += dropped + sum(1 for event in events if event is not None)
+            except OSError:
+                # The reader went away; stop writing rather than slow down the run.
+                self.broken = True
+                return
+            if None in events:
+                return
+
+    def close(self):
+        """Writes out the queued events (waiting at most EVENT_CLOSE_TIMEOUT) and closes the target."""
+        if not self.broken:
+            try:
+                self.queue.put(None, timeout=EVENT_CLOSE_TIMEOUT)
+            except queue.Full:
+                pass
+            self.thread.join(EVENT_CLOSE_TIMEOUT)
+        try:
+            self._close()
+        except OSError:
+            pass
+
+class EventStage:
+    """
+    Emits stage_started now and stage_finished, with the elapsed seconds, on finish().
+    The duration is also recorded in the run metrics.
+    """
+    def __init__(self, stage, **fields):
+        self.stage = stage
+        self.start = time.monotonic()
+        emit_event('stage_started', stage=stage, **fields)
+
+    def finish(self, **fields):
+        seconds = time.monotonic() - self.start
+        emit_event('stage_finished', stage=self.stage, seconds=round(seconds, 3), **fields)
+        if _run_metrics:
+            _run_metrics.observe('subrename_stage_duration_seconds', seconds, stage=self.stage)
+
+# The open EventStream, or None if EVENT_STREAM is not set.
+_event_stream = None
+
+def emit_event(event, **fields):
+    """Queues one event for the EVENT_STREAM. Does nothing if there is none, and never blocks."""
+    if _event_stream:
+        _event_stream.emit(event, fields)
+
+def open_event_stream():
+    global _event_stream
+    target = CONFIG.get("EVENT_STREAM")
+    if not target:
+        return
+    try:
+        _event_stream = EventStream.open(str(target))
+    except (OSError, ValueError) as e:
+        print(f"{COLOR_RED}警告：无法打开事件流 '{target}': {e}{COLOR_RESET}")
+        return
+    atexit.register(close_event_stream)
+
+def close_event_stream():
+    global _event_stream
+    if _event_stream:
+        _event_stream.close()
+        _event_stream = None
+
+# --- Run metrics ---
+# Upper bounds (seconds) of the stage duration histogram buckets.
+METRIC_DURATION_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 1800.0)
+# name -> (type, help). Counter names end in _total as the textfile collector expects.
+METRIC_DEFINITIONS = collections.OrderedDict([
+    ('subrename_runs_total', ('counter', "Program runs.")),
+    ('subrename_files_scanned_total', ('counter', "Files and font folders collected from the dropped paths.")),
+    ('subrename_files_renamed_total', ('counter', "Subtitle files created under their new name.")),
+    ('subrename_unmatched_subtitles_total', ('counter', "Subtitles skipped in SP mode for lack of a matching video.")),
+    ('subrename_bytes_copied_total', ('counter', "Bytes written to new subtitle files.")),
+    ('subrename_fonts_processed_total', ('counter', "Font archives and folders moved or copied.")),
+    ('subrename_errors_total', ('counter', "Failed file operations, by operation.")),
+    ('subrename_stage_duration_seconds', ('histogram', "Duration of each processing stage.")),
+    ('subrename_last_run_timestamp_seconds', ('gauge', "Time the last run finished.")),
+])
+# Sample name suffixes whose values are added to those of earlier runs.
+METRIC_CUMULATIVE_SUFFIXES = ('_total', '_bucket', '_sum', '_count')
+
+class RunMetrics:
+    """Counters and stage duration histograms of one run, written in the Prometheus text format."""
+    def __init__(self):
+        self.samples = collections.OrderedDict() # (name, labels) -> value
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        for bound in METRIC_DURATION_BUCKETS:
+            self.add(name + '_bucket', 1 if value <= bound else 0, le=str(bound), **labels)
+        self.add(name + '_bucket', le='+Inf', **labels)
+        self.add(name + '_sum', value, **labels)
+        self.add(name + '_count', **labels)
+
+    @staticmethod
+    def _sample_key(name, labels):
+        """The sample as written in the file, without its value: name{label="value",...}."""
+        if not labels:
+            return name
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return name + '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    @staticmethod
+    def _family(sample_key):
+        name = sample_key.split('{')[0]
+        return name if name in METRIC_DEFINITIONS else name.rsplit('_', 1)[0]
+
+    @staticmethod
+    def read_previous(path):
+        """Cumulative samples of an earlier metrics file, as sample key -> value."""
+        previous = collections.OrderedDict()
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    sample_key, _, value = line.strip().rpartition(' ')
+                    if sample_key and not sample_key.startswith('#') and sample_key.split('{')[0].endswith(METRIC_CUMULATIVE_SUFFIXES):
+                        try:
+                            previous[sample_key] = float(value)
+                        except ValueError:
+                            pass
+        except OSError:
+            pass
+        return previous
+
+    def render(self, previous=None):
+        """The metrics file text; cumulative samples include the values in `previous`."""
+        previous = collections.OrderedDict(previous or {})
+        self.samples[('subrename_last_run_timestamp_seconds', ())] = time.time()
+        values = collections.OrderedDict()
+        for (name, labels), value in self.samples.items():
+            sample_key = self._sample_key(name, labels)
+            if name.endswith(METRIC_CUMULATIVE_SUFFIXES):
+                value += previous.pop(sample_key, 0)
+            values[sample_key] = value
+        # Samples of earlier runs that did not occur in this one are carried over.
+        values.update(previous)
+        lines = []
+        for family, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            samples = [(sample_key, value) for sample_key, value in values.items() if self._family(sample_key) == family]
+            if not samples:
+                continue
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+            for sample_key, value in samples:
+                value = int(value) if float(value).is_integer() else round(value, 6)
+                lines.append(f"{sample_key} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Adds this run to the counters in `path` and replaces the file in one step."""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            text = self.render(self.read_previous(path))
+            with open(temp_path, 'w', encoding='utf-8', newline='\n') as f:
+                f.write(text)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"{COLOR_RED}警告：无法将运行统计写入 '{path}': {e}{COLOR_RESET}")
+
+# The current run's RunMetrics, or None if METRICS_FILE is not set.
+_run_metrics = None
+
+def count_metric(name, value=1, **labels):
+    """Adds to a counter of METRIC_DEFINITIONS. Does nothing if METRICS_FILE is not set."""
+    if _run_metrics:
+        _run_metrics.add(name, value, **labels)
+
+def start_run_metrics():
+    global _run_metrics
+    if CONFIG.get("METRICS_FILE"):
+        _run_metrics = RunMetrics()
+        _run_metrics.add('subrename_runs_total')
+
+def write_run_metrics():
+    if _run_metrics:
+        _run_metrics.write(os.path.abspath(os.path.expanduser(str(CONFIG["METRICS_FILE"]))))
+
+# Sequences of digits (with optional decimal part), or sequences of non-digits.
+NATURAL_SORT_PATTERN = re.compile(r'(\d+\.\d+|\d+)|(\D+)')
 
 def natural_sort_key(s):
     """
     Key for natural sorting. Handles strings, integers, and floats correctly
     by separating them into typed tuples.
     """
-    key = []
-    # This regex finds all sequences of digits (with optional decimal part)
-    # or sequences of non-digits.
-    parts = re.findall(r'(\d+\.\d+|\d+|\D+)', s)
-    for part in parts:
-        try:
-            # Mark numbers with a 0 prefix for correct type comparison
-            key.append((0, float(part)))
-        except ValueError:
-            # Mark strings with a 1 prefix
-            key.append((1, part.lower()))
-    return key
+    # Numbers are marked with a 0 prefix and strings with a 1 prefix for correct type comparison.
+    # The regex group tells them apart, which is much cheaper than trying float() on every part.
+    return [(0, float(number)) if number else (1, text.lower()) for number, text in NATURAL_SORT_PATTERN.findall(s)]
 
 def _convert_chinese_num_to_str(cn_num_str):
     """Helper to convert Chinese numerals up to 99 to a string digit."""
@@ -95,9 +969,101 @@ def _convert_chinese_num_to_str(cn_num_str):
     
     return str(num) if num > 0 else None
 
+# prefix (OVA, SP...), number, decimal part, version: "10", "10.5", "01v2", "OVA01", "OVA".
+EPISODE_ID_PATTERN = re.compile(r'(?i)([A-Z]*?)\s*(\d+)?(?:\.(\d+))?(?:v(\d+))?')
+
+class EpisodeId:
+    """
+    An immutable, hashable episode identifier: a regular episode (season if the name gives
+    one, number, decimal part, version), a special (OVA01, SP 2.5, or a bare OVA), a single
+    file (movie-style name without a number) or text that fits none of these. The sort key
+    is built once, so equality, hashing and ordering are tuple operations; '01', '1' and
+    '001' are the same episode, while '01v2' is a different release of it (no version
+    counts as v1). str() gives the text it was parsed from, with its season (S01E03).
+    """
+    __slots__ = ('special', 'number', 'decimal', 'version', 'title', 'text', 'season', 'key')
+
+    def __init__(self, text, special='', number=None, decimal='', version=None, title=None, season=None):
+        for name, value in (('text', text), ('special', special), ('number', number), ('decimal', decimal),
+                            ('version', version), ('title', title), ('season', season)):
+            object.__setattr__(self, name, value)
+        decimal_value = int(decimal) / 10 ** len(decimal) if decimal else 0.0
+        if title is not None:
+            key = (2, tuple(natural_sort_key(title)), title)
+        elif number is None and not special:
+            key = (3, text.upper())
+        else:
+            key = (1 if special else 0, season or 0, special, -1 if number is None else number, decimal_value,
+                   1 if version is None else version)
+        object.__setattr__(self, 'key', key)
+
+    @classmethod
+    def parse(cls, text, season=None):
+        """EpisodeId for an identifier like '10', '10.5', '01v2' or 'OVA01', or None for empty text."""
+        if not text:
+            return None
+        match = EPISODE_ID_PATTERN.fullmatch(text.strip())
+        if not match or not (match.group(1) or match.group(2)):
+            return cls(text)
+        special, number, decimal, version = match.groups()
+        return cls(text, special.upper(), None if number is None else int(number), decimal or '',
+                   None if version is None else int(version), season=season)
+
+    def without_season(self):
+        """The same episode with no season, for matching names that leave the season out."""
+        if self.season is None:
+            return self
+        return EpisodeId(self.text, self.special, self.number, self.decimal, self.version, self.title)
+
+    @classmethod
+    def single(cls, name):
+        """EpisodeId for a file without an episode number, grouped by its name (movie mode)."""
+        return cls(name, title=name)
+
+    @property
+    def is_single(self):
+        return self.title is not None
+
+    def format(self, width, special_separator=' '):
+        """The id with its number padded to width; specials keep their prefix (OVA 01)."""
+        if self.number is None or self.version is not None:
+            return self.text
+        if self.special:
+            return f"{self.special}{special_separator}{self.number:0{width}d}"
+        if self.decimal:
+            return f"{self.number:0{width}d}.{self.decimal}"
+        return f"{self.number:0{width}d}"
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EpisodeId is immutable")
+
+    def __reduce__(self):
+        # Slotted and immutable: rebuild through __init__ when sent to a worker process.
+        return (EpisodeId, (self.text, self.special, self.number, self.decimal, self.version, self.title, self.season))
+
+    def __eq__(self, other):
+        return isinstance(other, EpisodeId) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.text if self.season is None else f"S{self.season:02d}E{self.text}"
+
+    def __repr__(self):
+        if self.season is None:
+            return f"EpisodeId({self.text!r})"
+        return f"EpisodeId({self.text!r}, season={self.season})"
+
 def extract_episode_identifier(filename):
     """
-    Extracts a normalized episode identifier from a filename, handling specials and decimals.
+    Extracts the episode identifier (an EpisodeId) from a filename, handling specials and decimals.
     """
     # Chinese Word to Number first
     cn_pattern = r'第([一二三四五六七八九十百]+)(?:集|話|话)'
@@ -106,7 +1072,7 @@ def extract_episode_identifier(filename):
         cn_num_str = cn_match.group(1)
         arabic_num_str = _convert_chinese_num_to_str(cn_num_str)
         if arabic_num_str:
-            return arabic_num_str
+            return EpisodeId.parse(arabic_num_str)
             
     # Patterns for specials (e.g., OVA 01, SP 02, or just OVA)
     special_patterns = [
@@ -121,11 +1087,11 @@ def extract_episode_identifier(filename):
             # For specials, combine the prefix and number to create a unique ID (e.g., "OVA01")
             groups = [g for g in match.groups() if g is not None]
             # Normalize to remove spaces and ensure consistency
-            return "".join(groups).upper()
+            return EpisodeId.parse("".join(groups).upper())
 
     # Patterns for regular episodes, now supporting decimals and international formats
     regular_patterns = [
-        r'(?i)S\d{1,2}E(\d{1,3}(?:\.\d)?)',       # For S01E01, S01E10.5 etc.
+        r'(?i)S(\d{1,2})E(\d{1,3}(?:\.\d(?!\d))?)', # For S01E01, S01E10.5 etc.
         r'第(\d{1,3}(?:\.\d)?)(?:集|話|话)',      # For 第1集, 第1話, 第1话
         r'(\d{1,3}(?:\.\d)?)\s*화',              # For 1화 (Korean)
         r'(?i)(?:Episodio|Episódio|Episod)\s*(\d{1,3}(?:\.\d)?)', # Italian, Spanish, Portuguese, Malay
@@ -145,57 +1111,233 @@ def extract_episode_identifier(filename):
     for pattern in regular_patterns:
         match = re.search(pattern, filename)
         if match:
-            # Return the last non-empty group, which is always the number
-            return [g for g in match.groups() if g is not None][-1].strip()
+            # The last non-empty group is always the number; S01E03 also gives the season first.
+            groups = [g for g in match.groups() if g is not None]
+            return EpisodeId.parse(groups[-1].strip(), int(groups[0]) if len(groups) > 1 else None)
             
     return None
 
-def expand_paths(paths, recursive=True):
+# --- Configuration files ---
+# Settings shared by both script versions; same keys and values as CONFIG, in JSON.
+USER_CONFIG_PATH = os.environ.get('SUBRENAME_CONFIG') or os.path.join(os.path.expanduser('~'), '.subrename', 'config.json')
+# Per-folder overrides, applied to that folder and everything below it.
+DIRECTORY_CONFIG_NAME = '.subrename'
+
+# Absolute folder path -> settings from its .subrename file (None if it has none).
+_directory_configs = {}
+
+def read_config_file(path):
+    """Known CONFIG settings from a JSON config file, or {} if it cannot be read."""
+    try:
+        with open(path, encoding='utf-8-sig') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"{COLOR_RED}警告：无法读取配置文件 '{path}': {e}{COLOR_RESET}")
+        return {}
+    if not isinstance(data, dict):
+        print(f"{COLOR_RED}警告：配置文件 '{path}' 必须是 JSON 对象，已忽略。{COLOR_RESET}")
+        return {}
+    unknown = sorted(key for key in data if key not in CONFIG)
+    if unknown:
+        print(f"{COLOR_RED}警告：已忽略 '{path}' 中的未知设置: {', '.join(unknown)}{COLOR_RESET}")
+    return {key: value for key, value in data.items() if key in CONFIG}
+
+def load_user_config():
+    """Applies the user config file, if there is one, on top of the CONFIG defaults."""
+    if os.path.isfile(USER_CONFIG_PATH):
+        CONFIG.update(read_config_file(USER_CONFIG_PATH))
+
+def get_directory_config(directory):
+    """Settings from the .subrename file in one folder (not its parents), or None."""
+    directory = os.path.abspath(directory)
+    if directory not in _directory_configs:
+        config_path = os.path.join(directory, DIRECTORY_CONFIG_NAME)
+        _directory_configs[directory] = read_config_file(config_path) if os.path.isfile(config_path) else None
+    return _directory_configs[directory]
+
+def get_effective_overrides(directory):
+    """Merged .subrename settings for a folder: outer folders first, so the closest folder wins."""
+    chain = []
+    directory = os.path.abspath(directory)
+    while True:
+        chain.append(directory)
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    overrides = {}
+    for folder in reversed(chain):
+        overrides.update(get_directory_config(folder) or {})
+    return overrides
+
+def partition_by_directory_config(paths):
+    """
+    Splits dropped paths by the effective .subrename settings of their folders.
+    Returns [(overrides, paths)] in first-seen order; one ({}, paths) entry when no folder has settings.
+    """
+    partitions = {}
+    overrides_by_dir = {}
+    for path in paths:
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory not in overrides_by_dir:
+            overrides_by_dir[directory] = get_effective_overrides(directory)
+        overrides = overrides_by_dir[directory]
+        partition_key = json.dumps(overrides, sort_keys=True)
+        partitions.setdefault(partition_key, (overrides, []))[1].append(path)
+    return list(partitions.values())
+
+# --- Directory traversal ---
+# Directory listings run on this many threads; on network shares each listing is a round trip.
+WALK_WORKERS = 8
+JUNK_FILENAMES = {'.ds_store', 'thumbs.db', 'desktop.ini'}
+
+def _compile_name_globs(patterns):
+    """Compiles name wildcards into one case-insensitive regex, or None if there are none."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE)
+
+def get_scan_rules(include=None):
+    """(include, exclude, prune) regexes for a folder scan, from SCAN_EXCLUDE/SCAN_PRUNE_DIRS and the given include list."""
+    return (_compile_name_globs(include),
+            _compile_name_globs(CONFIG.get("SCAN_EXCLUDE")),
+            _compile_name_globs(CONFIG.get("SCAN_PRUNE_DIRS")))
+
+def _scan_directory(path, rules):
+    """
+    Lists one directory as (font_dirs, files, subdirs, config_path), each in listing order.
+    Font folders are kept as units and symlinked folders are not descended into, like os.walk.
+    Pruned folders and filtered files are dropped here, so pruned subtrees are never listed.
+    config_path is the folder's .subrename file, or None.
+    """
+    include, exclude, prune = rules
+    font_dirs, files, subdirs = [], [], []
+    config_path = None
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if prune and prune.match(entry.name):
+                    continue
+                if re.search(r'(?i)font', entry.name):
+                    font_dirs.append(entry.path)
+                elif not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif entry.name == DIRECTORY_CONFIG_NAME:
+                config_path = entry.path
+            elif entry.name.lower() not in JUNK_FILENAMES:
+                if include and not include.match(entry.name) or exclude and exclude.match(entry.name):
+                    continue
+                files.append(entry.path)
+    return font_dirs, files, subdirs, config_path
+
+def walk_directories(roots, recursive=True, include=None):
+    """
+    Lists files (and Font folders) under several directories at once. Listings from all
+    roots share one bounded thread pool, and every finished listing queues its subfolders,
+    so a deep root never leaves the other workers idle. The result is in the same
+    top-down order a sequential walk of each root would produce.
+    include limits the collected files to names matching those wildcards.
+    """
+    rules = get_scan_rules(include)
+    listings = {}
+    errors = {}
+    queued = set(roots)
+    file_count = 0
+    with ThreadPoolExecutor(max_workers=WALK_WORKERS) as executor:
+        pending = {executor.submit(_scan_directory, root, rules): root for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    listing = future.result()
+                except OSError as e:
+                    errors[path] = e
+                    continue
+                listings[path] = listing
+                file_count += len(listing[1])
+                emit_event('scan_progress', folders=len(listings), files=file_count, pending=len(pending))
+                # Remember each folder's .subrename file now, so it is never looked up again.
+                _directory_configs[os.path.abspath(path)] = read_config_file(listing[3]) if listing[3] else None
+                if recursive:
+                    for subdir in listing[2]:
+                        if subdir not in queued:
+                            queued.add(subdir)
+                            pending[executor.submit(_scan_directory, subdir, rules)] = subdir
+
+    expanded = []
+    for root in roots:
+        if root in errors:
+            print(f"{COLOR_RED}无法访问 '{root}': {errors[root]}{COLOR_RESET}")
+            continue
+        stack = [root]
+        while stack:
+            listing = listings.get(stack.pop())
+            if not listing:
+                # Unreadable subfolders are skipped, as os.walk does.
+                continue
+            font_dirs, files, subdirs, _ = listing
+            expanded.extend(font_dirs)
+            expanded.extend(files)
+            if recursive:
+                stack.extend(reversed(subdirs))
+    return expanded
+
+def expand_paths(paths, recursive=True, include=None):
     """
     Expands directories in the list to include files.
     If recursive is True, walks all subdirectories.
     If recursive is False, only checks the top level of directories.
     Handles Font folders as units.
+    Files found in folders are filtered by include and SCAN_EXCLUDE; explicitly given files are always kept.
     """
     expanded = []
+    # Consecutive folders are walked together so their listings share the thread pool.
+    pending_dirs = []
     for p in paths:
+        if os.path.isdir(p) and not re.search(r'(?i)font', os.path.basename(p.rstrip(os.sep))):
+            pending_dirs.append(p)
+            continue
+        if pending_dirs:
+            expanded.extend(walk_directories(pending_dirs, recursive=recursive, include=include))
+            pending_dirs = []
         if os.path.isfile(p):
             expanded.append(p)
         elif os.path.isdir(p):
-            # Check if the folder is a Font folder (treat as unit)
-            if re.search(r'(?i)font', os.path.basename(p.rstrip(os.sep))):
-                expanded.append(p)
-            else:
-                if recursive:
-                    for root, dirs, files in os.walk(p):
-                        font_dirs = [d for d in dirs if re.search(r'(?i)font', d)]
-                        for fd in font_dirs:
-                            expanded.append(os.path.join(root, fd))
-                            dirs.remove(fd)
-                        
-                        for f in files:
-                            if f.lower() in ['.ds_store', 'thumbs.db', 'desktop.ini']:
-                                continue
-                            expanded.append(os.path.join(root, f))
-                else:
-                    try:
-                        for entry in os.scandir(p):
-                            if entry.is_file():
-                                if entry.name.lower() in ['.ds_store', 'thumbs.db', 'desktop.ini']:
-                                    continue
-                                expanded.append(entry.path)
-                            elif entry.is_dir() and re.search(r'(?i)font', entry.name):
-                                expanded.append(entry.path)
-                    except PermissionError as e:
-                        print(f"{COLOR_RED}无法访问 '{p}': {e}{COLOR_RESET}")
+            # Font folder (treat as unit)
+            expanded.append(p)
+    if pending_dirs:
+        expanded.extend(walk_directories(pending_dirs, recursive=recursive, include=include))
 
     return expanded
 
+@contextlib.contextmanager
+def config_overlay(overrides):
+    """Temporarily replaces CONFIG values; the previous values are restored on exit."""
+    saved = {key: CONFIG[key] for key in overrides if key in CONFIG}
+    CONFIG.update(overrides)
+    try:
+        yield
+    finally:
+        for key in overrides:
+            if key in saved:
+                CONFIG[key] = saved[key]
+            else:
+                CONFIG.pop(key, None)
+
+# Answers given to preset questions in the current batch (CONFIG key -> choice), for series profiles.
+_session_choices = {}
+
 def ask_with_preset(config_key, question, options):
     """Generic function to ask a question or use a preset."""
     preset_value = CONFIG.get(config_key)
     if preset_value is not None and preset_value in options.keys():
         print(f"\n发现预设值 '{question}': 将按照 '{options[preset_value]}'进行处理")
+        _session_choices[config_key] = preset_value
         return preset_value
     
     print(f"\n{question}")
@@ -204,22 +1346,28 @@ def ask_with_preset(config_key, question, options):
     
     while True:
         try:
-            choice = int(input(f"请输入您的选择 ({'/'.join(map(str, options.keys()))}): "))
+            choice = int(read_line(f"请输入您的选择 ({'/'.join(map(str, options.keys()))}): "))
             if choice in options.keys():
+                if config_key:
+                    _session_choices[config_key] = choice
                 return choice
             else: print(f"{COLOR_RED}无效选择{COLOR_RESET}")
         except ValueError: print(f"{COLOR_RED}无效输入{COLOR_RESET}")
 
-def get_files_from_user(prompt_message):
+def get_files_from_user(prompt_message, allow_library=False, include=None):
     """
     Gets a list of file paths from user drag-and-drop input.
     Validates input and asks for recursion if subfolders are detected.
+    Returns 'library' if library mode was requested (only when allow_library is set).
+    include limits the files collected from folders (see expand_paths).
     """
     print(prompt_message)
+    if allow_library:
+        print("- 输入 'lib' 可进入媒体库模式（将媒体库文件夹中的所有字幕与对应视频自动匹配）")
     print("- 需退出可直接按回车键")
     print("-" * 50)
     try:
-        paths_input = input()
+        paths_input = read_line()
     except KeyboardInterrupt:
         print(f"\n{COLOR_RED}用户取消操作{COLOR_RESET}")
         return None
@@ -227,6 +1375,9 @@ def get_files_from_user(prompt_message):
     if not paths_input.strip():
         return None
 
+    if allow_library and paths_input.strip().lower() == 'lib':
+        return 'library'
+
     # Easter Egg check
     if paths_input.strip().lower() == 'jjj':
         clear_screen()
@@ -352,7 +1503,7 @@ def get_files_from_user(prompt_message):
               请访问 https://github.com/Yamada-da/SubRename 获取最新版（大概应该有）
               在issues里等待你遇到的奇葩问题（请附上文件名和描述）
               """)
-        input("请按回车键返回...")
+        read_line("请按回车键返回...")
         return 'restart'
 
     # Path parsing
@@ -362,7 +1513,7 @@ def get_files_from_user(prompt_message):
     
     if not cleaned_paths:
         print(f"\n{COLOR_RED}错误：无效输入{COLOR_RESET}")
-        input("请按回车键返回...")
+        read_line("请按回车键返回...")
         return 'restart'
 
     # Path validation
@@ -376,16 +1527,17 @@ def get_files_from_user(prompt_message):
 
     if not valid_inputs or invalid_found and not valid_inputs:
         print(f"\n{COLOR_RED}错误：文件路径无效，请尝试拖入文件，而非手动输入字符{COLOR_RESET}")
-        input("请按回车键返回...")
+        read_line("请按回车键返回...")
         return 'restart'
 
     # Check for subdirectories to ask about recursion
     has_subdirs = False
+    prune = get_scan_rules()[2]
     for path in valid_inputs:
         if os.path.isdir(path):
             try:
                 for entry in os.scandir(path):
-                    if entry.is_dir() and not re.search(r'(?i)font', entry.name):
+                    if entry.is_dir() and not re.search(r'(?i)font', entry.name) and not (prune and prune.match(entry.name)):
                         has_subdirs = True
                         break
             except PermissionError:
@@ -399,59 +1551,982 @@ def get_files_from_user(prompt_message):
                                  {1: "仅处理当前目录", 2: "处理包含子目录的所有目录"})
         recursive = (choice == 2)
 
-    return expand_paths(valid_inputs, recursive=recursive)
+    stage = EventStage('scan', roots=valid_inputs, recursive=recursive)
+    expanded = expand_paths(valid_inputs, recursive=recursive, include=include)
+    stage.finish(items=len(expanded))
+    count_metric('subrename_files_scanned_total', len(expanded))
+    set_ui_pane('inputs', [f"在以下位置找到 {len(expanded)} 项:"] + valid_inputs)
+    return expanded
+
+# --- Path lists ---
+# Path lists are read in blocks of this many bytes, never as a whole.
+PATH_LIST_CHUNK_SIZE = 1 << 16
+
+# (binary stream, NUL-delimited, name) of the path list given with --from-list, used for the first batch.
+_path_list = None
+
+def open_path_list(source):
+    """
+    Binary stream for a path list: a file, or standard input for '-'. Piped input is moved
+    to its own file descriptor and standard input is pointed back at the console, so the
+    questions that follow can still be answered.
+    """
+    if source != '-':
+        return open(source, 'rb')
+    stream = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    try:
+        console = os.open('CONIN$' if os.name == 'nt' else '/dev/tty', os.O_RDWR)
+    except OSError:
+        print(f"{COLOR_RED}没有可用于回答问题的控制台；所有问题都需要预设。{COLOR_RESET}")
+        return stream
+    os.dup2(console, sys.stdin.fileno())
+    os.close(console)
+    return stream
+
+def iter_path_list(stream, null_delimited=False):
+    """
+    Yields the paths of a NUL-delimited (find -print0) or newline-delimited list one at a
+    time, reading the stream in blocks. Empty entries and the '\r' of Windows line endings
+    are dropped; bytes that aren't valid in the file system encoding are kept as-is.
+    """
+    separator = b'\0' if null_delimited else b'\n'
+    pending = b''
+    while True:
+        chunk = stream.read(PATH_LIST_CHUNK_SIZE)
+        entries = (pending + chunk).split(separator)
+        # The last entry may continue in the next block.
+        pending = entries.pop() if chunk else b''
+        for entry in entries:
+            if not null_delimited:
+                entry = entry.rstrip(b'\r')
+            if entry:
+                yield os.fsdecode(entry)
+        if not chunk:
+            return
+
+def get_files_from_list(stream, null_delimited=False, name='-', include=None):
+    """
+    Collects the files named in a path list, in place of the drag-and-drop prompt.
+    Paths are checked and expanded as they are read, so the list is never held as one
+    string. Listed files are filtered by include and SCAN_EXCLUDE like files found in
+    folders; listed folders are scanned without their subfolders, since a list made
+    with find already names those. Files named twice are kept once.
+    """
+    include_rule, exclude_rule, _ = get_scan_rules(include)
+    missing = 0
+    def listed_paths():
+        nonlocal missing
+        for path in iter_path_list(stream, null_delimited):
+            if os.path.isdir(path):
+                yield path
+            elif not os.path.isfile(path):
+                missing += 1
+            else:
+                filename = os.path.basename(path)
+                if not (include_rule and not include_rule.match(filename) or exclude_rule and exclude_rule.match(filename)):
+                    yield path
+
+    stage = EventStage('scan', roots=[name], recursive=False)
+    try:
+        expanded = list(dict.fromkeys(expand_paths(listed_paths(), recursive=False, include=include)))
+    finally:
+        stream.close()
+    stage.finish(items=len(expanded))
+    if missing:
+        print(f"{COLOR_RED}列表中有 {missing} 个路径不存在，已跳过。{COLOR_RESET}")
+    if not expanded:
+        print(f"\n{COLOR_RED}错误：路径列表 '{name}' 中没有可用的文件。{COLOR_RESET}")
+        read_line("请按回车键返回...")
+        return 'restart'
+    count_metric('subrename_files_scanned_total', len(expanded))
+    set_ui_pane('inputs', [f"在以下位置找到 {len(expanded)} 项:", name])
+    print(f"已从路径列表 '{name}' 读取 {len(expanded)} 项。")
+    return expanded
+
+
+# --- Language tags ---
+# 如需增加对其他语言缩写的自动识别，请在此增补
+LANGUAGE_CODES = {'ar', 'bg', 'ca', 'cs', 'da', 'de', 'el', 'en', 'es', 'fi', 'fr', 'hi', 'hu', 'id', 'is', 'it', 'ja', 'jp', 'ko', 'lt', 'lv', 'ms', 'my', 'nb', 'ne', 'nl', 'nn', 'pl', 'pt', 'ro', 'ru', 'sc', 'sk', 'sl', 'sv', 'tc', 'th', 'tl', 'tr', 'uk', 'ur', 'vi', 'zh', 'ara', 'ces', 'chs', 'cht', 'chi', 'cho', 'dan', 'deu', 'ell', 'eng', 'fil', 'fin', 'fra', 'heb', 'hun', 'hy', 'ind', 'isl', 'ita', 'jpn', 'kor', 'lat', 'nor', 'pol', 'por', 'ron', 'rus', 'slk', 'slv', 'spa', 'swe', 'tha', 'tur', 'ukr', 'und', 'vie', 'zho', 'zxx', 'ensc', 'entc', 'enjp', 'jpen', 'jpsc', 'jptc', 'scjp', 'scen', 'tcjp', 'tcen', 'zh-CN', 'zh-HK', 'zh-MO', 'zh-SG', 'zh-TW', 'chs-eng', 'cht-eng', 'de-AT', 'de-CH', 'en-AU', 'en-CA', 'en-GB', 'en-IE', 'en-NZ', 'en-US', 'en-ZA', 'en_sc', 'en_tc', 'en+sc', 'en+tc', 'es-419', 'es-LA', 'es-MX', 'es-ES', 'fr-BE', 'fr-CA', 'it-CH', 'nl-BE', 'pt-BR', 'pt-PT', 'sc-en', 'sc-jp', 'sr-Cyrl', 'sr-Latn', 'tc-en', 'tc-jp', 'zh-Hans', 'zh-Hant', 'chs&jpn', 'cht&jpn', 'eng&jpn', 'engsub', 'en-forced', 'sc&tc'}
+# Tags that name a language without using its code, mostly in brackets ([简繁], [BIG5]).
+LANGUAGE_TAG_ALIASES = {'简': 'sc', '简体': 'sc', '简中': 'sc', 'gb': 'sc', '繁': 'tc', '繁体': 'tc', '繁體': 'tc', '繁中': 'tc', 'big5': 'tc',
+                        '简繁': 'sc&tc', '繁简': 'sc&tc', '简日': 'scjp', '繁日': 'tcjp'}
+LANGUAGE_CODES_LOWER = {code.lower() for code in LANGUAGE_CODES}
+# Codes that are also words, names or release tags (Tom und Jerry, Fin, Dan, [HI] = hearing
+# impaired); only trusted right before the extension.
+LANGUAGE_SUFFIX_ONLY_CODES = {'und', 'zxx', 'fin', 'nor', 'lat', 'por', 'ind', 'dan', 'hi', 'it', 'is', 'my', 'id', 'ne', 'ms', 'tl', 'hy'}
+# Where a tag may stand: 'suffix' = its own segment before the extension (Show 01.en.ass),
+# 'bracket' = a whole bracket ([CHS], or [CHS_JPN] for several languages), 'delimited' = between
+# . _ - right before the extension or right after the episode number (Show_01_eng.ass).
+LANGUAGE_TAG_KINDS = ('suffix', 'bracket', 'delimited')
+LANGUAGE_TAG_OPENERS = set('[(【')
+LANGUAGE_TAG_CLOSERS = set('])】')
+LANGUAGE_TAG_DELIMITERS = set('._-')
+# Separators between the languages of one bracket; joined codes are looked up in this order.
+LANGUAGE_TAG_JOINERS = ('', '&', '-', '_', '+')
+LANGUAGE_TAG_JOINER_PATTERN = re.compile(r'[_&+\-]')
+# Single letters and plain words separated by delimiters are too ambiguous ("it", "is", "my").
+LANGUAGE_DELIMITED_MIN_LENGTH = 3
+FILE_EXTENSION_PATTERN = re.compile(r'\.[a-z]{2,4}$')
+
+class TagScanner:
+    """
+    Aho-Corasick automaton over a fixed set of tags: one pass over a text finds every
+    occurrence of every tag, overlapping ones included, in time linear in the length of
+    the text plus the number of matches. Built once; scan() only follows table entries.
+    """
+    def __init__(self, tags):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for tag in tags:
+            node = 0
+            for char in tag:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                node = self.goto[node][char]
+            self.output[node] = (tag,)
+
+        # Breadth-first, so the failure link of every shallower node is known already.
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+                pending.append(child)
+
+    def scan(self, text):
+        """Yields (start, end, tag) for every occurrence of a tag in text, by end position."""
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for tag in output[node]:
+                yield index + 1 - len(tag), index + 1, tag
+
+_language_tag_scanner = None
+
+def _combine_language_tags(content):
+    """
+    Language code for a bracket naming several languages ('chs_jpn', 'gb_jp'): the registry
+    code that joins their codes (chs&jpn, scjp) if there is one, else the codes joined with
+    '&'. None if any part of the bracket is not a language tag.
+    """
+    codes = []
+    for part in LANGUAGE_TAG_JOINER_PATTERN.split(content):
+        code = LANGUAGE_TAG_ALIASES.get(part, part)
+        if code not in LANGUAGE_CODES_LOWER or part in LANGUAGE_SUFFIX_ONLY_CODES:
+            return None
+        codes.append(code)
+    for joiner in LANGUAGE_TAG_JOINERS:
+        if joiner.join(codes) in LANGUAGE_CODES_LOWER:
+            return joiner.join(codes)
+    return '&'.join(codes)
+
+def get_language_tag_precedence():
+    """LANGUAGE_TAG_PRECEDENCE as a tuple of known tag kinds; only the suffix if it is not set."""
+    precedence = CONFIG.get("LANGUAGE_TAG_PRECEDENCE") or ['suffix']
+    return tuple(kind for kind in precedence if kind in LANGUAGE_TAG_KINDS)
+
+def get_language_from_filename(filename, precedence=None):
+    """
+    Extracts the language code from a filename. All language codes and tag aliases in the
+    name are found in one pass; a candidate must stand on its own (see LANGUAGE_TAG_KINDS),
+    and the best one is picked by the order of its kind in precedence, then by length, then
+    by position. Returns "default" if the name has no language tag.
+    """
+    global _language_tag_scanner
+    if _language_tag_scanner is None:
+        _language_tag_scanner = TagScanner(LANGUAGE_CODES_LOWER | set(LANGUAGE_TAG_ALIASES))
+    if precedence is None:
+        precedence = get_language_tag_precedence()
+
+    text = filename.lower()
+    extension = FILE_EXTENSION_PATTERN.search(text)
+    if not extension:
+        return "default"
+    extension_start = extension.start()
+    best = None
+    for start, end, tag in _language_tag_scanner.scan(text):
+        if end > extension_start:
+            break
+        before = text[start - 1] if start else ''
+        after = text[end]
+        length = end - start
+        if before == '.' and end == extension_start:
+            kind = 'suffix'
+        elif tag in LANGUAGE_SUFFIX_ONLY_CODES:
+            continue
+        elif before in LANGUAGE_TAG_OPENERS and after in LANGUAGE_TAG_CLOSERS:
+            kind = 'bracket'
+        elif before in LANGUAGE_TAG_OPENERS and LANGUAGE_TAG_JOINER_PATTERN.match(after):
+            # First language of a bracket naming several; the whole bracket decides.
+            close = min((i for i in (text.find(c, end) for c in LANGUAGE_TAG_CLOSERS) if i >= 0), default=-1)
+            tag = _combine_language_tags(text[start:close]) if close >= 0 else None
+            if tag is None:
+                continue
+            kind = 'bracket'
+            length = close - start
+        elif before in LANGUAGE_TAG_DELIMITERS and after in LANGUAGE_TAG_DELIMITERS and len(tag) >= LANGUAGE_DELIMITED_MIN_LENGTH and \
+                (end == extension_start or start >= 2 and text[start - 2].isdigit()):
+            kind = 'delimited'
+        else:
+            continue
+        if kind not in precedence:
+            continue
+        rank = (precedence.index(kind), -length, start)
+        if best is None or rank < best[0]:
+            best = (rank, tag)
+    if best is None:
+        return "default"
+    return LANGUAGE_TAG_ALIASES.get(best[1], best[1])
+
+# --- Content sniffing ---
+# Only the first SNIFF_SAMPLE_BYTES of a file are ever read when sniffing.
+SNIFF_SAMPLE_BYTES = 16384
+TEXT_SUBTITLE_EXTENSIONS = {'.ass', '.ssa', '.srt', '.vtt', '.sub', '.txt', '.lrc', '.smi'}
+ENCODING_CANDIDATES = ['gb18030', 'big5', 'shift_jis', 'cp949']
+
+# Character-frequency tables: frequent characters that only exist in one of the two Chinese scripts.
+SIMPLIFIED_CHARS = set('这个们来说时会没对国为过还后样让么话点开现经发问间见长东门听头边觉谁谢吗欢爱乐学无实车机电两亲关给钱从当认备应该办写红颜书买卖读语请队岁负师伤传弹数战种难虽际极')
+TRADITIONAL_CHARS = set('這個們來說時會沒對國為過還後樣讓麼話點開現經發問間見長東門聽頭邊覺誰謝嗎歡愛樂學無實車機電兩親關給錢從當認備應該辦寫紅顏書買賣讀語請隊歲負師傷傳彈數戰種難雖際極')
+COMMON_CJK_CHARS = set('的一是不了人我在有他你她好也就都要到和那什没有大小上下中天日月年今明自己知道可以想去看出生事情里面真正手心')
+COMMON_HANGUL_CHARS = set('이다는을를가에의하고지나그서도한요게어니거')
+ENGLISH_MARKERS = (' the ', ' you ', ' and ', " i'm ", ' is ', ' to ', ' what ')
+
+_content_language_cache = {}
+
+def _file_cache_key(path):
+    """Cache key that changes whenever the file is replaced or modified."""
+    st = os.stat(path)
+    # Some file systems report no inode number; fall back to the path in that case.
+    return (st.st_dev, st.st_ino or path, st.st_mtime_ns)
+
+def read_file_sample(path, limit=SNIFF_SAMPLE_BYTES):
+    """Reads at most `limit` bytes from the start of a file."""
+    with open(path, 'rb') as f:
+        return f.read(limit)
+
+NON_ASCII_PATTERN = re.compile(rb'[\x80-\xff]')
+
+def read_encoding_sample(path, limit=SNIFF_SAMPLE_BYTES):
+    """
+    Sample for detect_text_encoding(): the start of the file, unless that is plain ASCII
+    (e.g. a long [Script Info]/[Fonts] header), in which case it is the `limit` bytes from
+    the first non-ASCII character on, since only those tell the encodings apart.
+    """
+    sample = read_file_sample(path, limit)
+    if len(sample) < limit or b'\x00' in sample or NON_ASCII_PATTERN.search(sample):
+        return sample
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            match = NON_ASCII_PATTERN.search(mapped, limit)
+            # A non-ASCII byte right after ASCII text always starts a character.
+            return mapped[match.start():match.start() + limit] if match else sample
+    except (OSError, ValueError):
+        return sample
+
+def _score_decoded_text(text):
+    """Counts characters that real subtitles use a lot. Wrong decodings score low."""
+    score = 0
+    for ch in text:
+        if ch in COMMON_CJK_CHARS or ch in SIMPLIFIED_CHARS or ch in TRADITIONAL_CHARS or ch in COMMON_HANGUL_CHARS:
+            score += 2
+        elif '\u3040' <= ch <= '\u30ff': # Hiragana and full-width Katakana
+            score += 1
+        elif '\uff61' <= ch <= '\uff9f' or ch == '\ufffd': # Half-width Katakana is a typical misdecoding
+            score -= 1
+    return score
+
+def detect_text_encoding(sample):
+    """
+    Guesses the encoding of a byte sample taken from the start of a text file.
+    Returns None if the sample does not look like text.
+    """
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+        if sample.startswith(bom):
+            return encoding
+    if b'\x00' in sample:
+        return None
+    try:
+        # The sample may end in the middle of a character, so decode incrementally.
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    best_encoding, best_score = None, 0
+    for encoding in ENCODING_CANDIDATES:
+        try:
+            text = codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        score = _score_decoded_text(text)
+        if best_encoding is None or score > best_score:
+            best_encoding, best_score = encoding, score
+    return best_encoding
+
+def _extract_dialogue_text(text):
+    """Keeps only the spoken lines of an .ass/.ssa or .srt-like subtitle."""
+    lines = text.splitlines()
+    dialogue = [line.split(',', 9) for line in lines if line.startswith('Dialogue:')]
+    if dialogue:
+        # .ass/.ssa: the text is the 10th field; drop override tags like {\an8} and line breaks.
+        return '\n'.join(re.sub(r'\{[^}]*\}|\\[Nnh]', ' ', parts[-1]) for parts in dialogue if len(parts) == 10)
+    # .srt-like: drop cue numbers and timing lines.
+    return '\n'.join(line for line in lines if line.strip() and not line.strip().isdigit() and '-->' not in line)
+
+def classify_text_script(text):
+    """
+    Classifies subtitle text by script, using character frequencies.
+    Returns 'sc', 'tc', 'jp', 'ko', 'en' or None if undecided.
+    """
+    kana = hangul = han = latin = simplified = traditional = 0
+    for ch in text:
+        if '\u3040' <= ch <= '\u30ff':
+            kana += 1
+        elif '\uac00' <= ch <= '\ud7a3':
+            hangul += 1
+        elif '\u4e00' <= ch <= '\u9fff':
+            han += 1
+            if ch in SIMPLIFIED_CHARS:
+                simplified += 1
+            elif ch in TRADITIONAL_CHARS:
+                traditional += 1
+        elif 'a' <= ch.lower() <= 'z':
+            latin += 1
+
+    if kana + hangul + han + latin < 20:
+        return None
+    if hangul > kana + han:
+        return 'ko'
+    # Japanese text is full of kana, Chinese text has (almost) none.
+    if kana > 0 and kana * 5 >= kana + han:
+        return 'jp'
+    # One Han character carries about as much as a short Latin word.
+    if han * 4 >= latin:
+        if simplified > traditional:
+            return 'sc'
+        if traditional > simplified:
+            return 'tc'
+        return None
+    padded = ' ' + ' '.join(text.lower().split()) + ' '
+    if any(marker in padded for marker in ENGLISH_MARKERS):
+        return 'en'
+    return None
+
+def sniff_content_language(path):
+    """
+    Detects the language of a text subtitle from its first few KB.
+    Results are cached per (inode, mtime), so each file is read at most once.
+    """
+    if os.path.splitext(path)[1].lower() not in TEXT_SUBTITLE_EXTENSIONS:
+        return None
+    try:
+        cache_key = _file_cache_key(path)
+        if cache_key in _content_language_cache:
+            return _content_language_cache[cache_key]
+        sample = read_file_sample(path)
+    except OSError:
+        return None
+
+    lang = None
+    encoding = detect_text_encoding(sample)
+    if encoding:
+        text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample, final=False)
+        lang = classify_text_script(_extract_dialogue_text(text))
+    _content_language_cache[cache_key] = lang
+    return lang
+
+def get_file_language(path):
+    """Language code of a subtitle file, optionally sniffing its content if the filename has none."""
+    lang = get_language_from_filename(os.path.basename(path))
+    if lang == "default" and CONFIG.get("SNIFF_CONTENT_LANGUAGE") == 1:
+        lang = sniff_content_language(path) or "default"
+    return lang
+
+# --- Subtitle header probing ---
+# Upper bound for reading the header sections of an .ass/.ssa file.
+SCRIPT_INFO_MAX_BYTES = 65536
+SCRIPT_INFO_CHUNK_BYTES = 4096
+# Header sections read by the probe. Aegisub 3 stores the video path in the section right after [Script Info].
+SCRIPT_INFO_SECTIONS = ('[script info]', '[aegisub project garbage]')
+HEADER_EPISODE_FIELDS = ('Video File', 'Original File', 'Audio File', 'Title')
+
+_script_info_cache = {}
+
+def read_script_info(path):
+    """
+    Reads the [Script Info] header fields of an .ass/.ssa file.
+    Reading stops at the first section after the header, and never goes past SCRIPT_INFO_MAX_BYTES.
+    Results are cached per (inode, mtime).
+    """
+    try:
+        cache_key = _file_cache_key(path)
+        if cache_key in _script_info_cache:
+            return _script_info_cache[cache_key]
+
+        info = {}
+        section = None
+        pending = ''
+        with open(path, 'rb') as f:
+            first_chunk = f.read(SCRIPT_INFO_CHUNK_BYTES)
+            decoder = codecs.getincrementaldecoder(detect_text_encoding(first_chunk) or 'utf-8')(errors='replace')
+            chunk, read_bytes = first_chunk, len(first_chunk)
+            while chunk:
+                lines = (pending + decoder.decode(chunk)).splitlines(True)
+                # Keep an incomplete last line for the next chunk.
+                pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+                for line in lines:
+                    line = line.strip().lstrip('\ufeff')
+                    if line.startswith('[') and line.endswith(']'):
+                        if section is not None and line.lower() not in SCRIPT_INFO_SECTIONS:
+                            chunk = None # Header is over, stop reading.
+                            break
+                        section = line.lower()
+                    elif section and ':' in line and not line.startswith(';'):
+                        field, value = line.split(':', 1)
+                        info.setdefault(field.strip(), value.strip())
+                if chunk is None or read_bytes >= SCRIPT_INFO_MAX_BYTES:
+                    break
+                chunk = f.read(SCRIPT_INFO_CHUNK_BYTES)
+                read_bytes += len(chunk)
+    except OSError:
+        return {}
+
+    _script_info_cache[cache_key] = info
+    return info
+
+def identify_episode(path):
+    """
+    Episode identifier for a subtitle file. Uses the release template inferred for its
+    folder, then the filename alone, then the video/title fields of the .ass/.ssa header
+    for files without a recognizable number.
+    """
+    if path in _inferred_episode_ids:
+        return _inferred_episode_ids[path]
+    episode_id = extract_episode_identifier(os.path.basename(path))
+    return episode_id or identify_episode_from_header(path)
+
+def identify_episode_from_header(path):
+    """Episode identifier from the video/title fields of an .ass/.ssa header, or None."""
+    if os.path.splitext(path)[1].lower() not in ('.ass', '.ssa'):
+        return None
+    info = read_script_info(path)
+    for field in HEADER_EPISODE_FIELDS:
+        value = info.get(field)
+        if value:
+            # Header paths may be absolute and use either separator.
+            episode_id = extract_episode_identifier(re.split(r'[\\/]', value)[-1])
+            if episode_id:
+                return episode_id
+    return None
+
+# --- Release template inference ---
+# A template is only trusted once this many names in one folder share it.
+TEMPLATE_MIN_FILES = 3
+TEMPLATE_TOKEN_PATTERN = re.compile(r'\d+|\D+')
+# A number right after one of these is a special (SP01), which the per-file patterns handle.
+TEMPLATE_SPECIAL_PREFIX_PATTERN = re.compile(r'(?i)(?:OVA|SP|OAD|NCOP|NCED|DVDSpot)\s*$')
+
+# path -> episode id found by infer_episode_identifiers(), consulted by identify_episode().
+# Cleared by main() before every batch.
+_inferred_episode_ids = {}
+
+def _is_decimal_episode(tokens, field):
+    """Whether the number at tokens[field] is followed by a one-digit decimal part (06.5 but not 01.720p)."""
+    return (len(tokens) > field + 2 and tokens[field + 1] == '.' and len(tokens[field + 2]) == 1 and tokens[field + 2].isdecimal()
+            and (len(tokens) == field + 3 or not tokens[field + 3][0].isalnum()))
+
+def infer_episode_identifiers(paths):
+    """
+    Episode identifiers from the naming template shared by the files of each folder.
+    Each name is split into text and number runs (up to its last number, so language tags
+    and extensions don't matter); names in one folder with the same text runs share a
+    template, and the single number that changes between them is the episode. Returns a
+    list aligned with paths, with None for outliers, which are left to the per-file patterns.
+    """
+    templates = {}
+    for index, path in enumerate(paths):
+        directory, filename = os.path.split(path)
+        # CRC32 tags change with every episode and would split the template.
+        tokens = TEMPLATE_TOKEN_PATTERN.findall(CRC32_TAG_PATTERN.sub('[crc]', filename))
+        last_number = max((i for i, token in enumerate(tokens) if token.isdecimal()), default=None)
+        if last_number is None:
+            continue
+        signature = tuple(None if token.isdecimal() else token for token in tokens[:last_number + 1])
+        templates.setdefault((directory, signature), []).append((index, tokens))
+
+    episode_ids = [None] * len(paths)
+    for (_, signature), members in templates.items():
+        if len(members) < TEMPLATE_MIN_FILES:
+            continue
+        varying = [i for i, token in enumerate(signature)
+                   if token is None and len({tokens[i] for _, tokens in members}) > 1]
+        # No varying number (one episode) or several (e.g. season folders mixed): no template.
+        if len(varying) != 1:
+            continue
+        field = varying[0]
+        if field > 0 and TEMPLATE_SPECIAL_PREFIX_PATTERN.search(signature[field - 1]):
+            continue
+        # "06.5", "11.5": the number that changes is only the integer part of a decimal episode.
+        if any(_is_decimal_episode(tokens, field) for _, tokens in members):
+            continue
+        for index, tokens in members:
+            if len(tokens[field]) <= 4:
+                episode_ids[index] = _inferred_episode_ids[paths[index]] = EpisodeId.parse(tokens[field])
+    return episode_ids
+
+# --- Batch filename parsing ---
+# Batches smaller than this are parsed in-process; starting a process pool costs more than it saves.
+PARALLEL_PARSE_THRESHOLD = 20000
+PARALLEL_PARSE_CHUNK_SIZE = 5000
+
+def _parse_filename_chunk(items, language_precedence=None):
+    """Parses a chunk of (filename, known episode id) pairs into compact (episode_id, lang, ext) tuples."""
+    return [(known_id or extract_episode_identifier(name), get_language_from_filename(name, language_precedence),
+             os.path.splitext(name)[1].lower())
+            for name, known_id in items]
+
+def parse_filenames_batch(filenames, known_ids=None):
+    """
+    Parses filenames into (episode_id, lang, ext) tuples in input order. Large batches are
+    split into chunks and parsed in a process pool; only the filename itself is looked at,
+    so header and content fallbacks stay with the caller. Names with an entry in known_ids
+    (e.g. from infer_episode_identifiers) skip the episode patterns.
+    """
+    filenames = list(filenames)
+    items = list(zip(filenames, known_ids or [None] * len(filenames)))
+    # Passed along, since worker processes may not have loaded the user's configuration.
+    precedence = get_language_tag_precedence()
+    workers = os.cpu_count() or 1
+    if len(items) < PARALLEL_PARSE_THRESHOLD or workers < 2:
+        return _parse_filename_chunk(items, precedence)
+
+    chunks = [items[i:i + PARALLEL_PARSE_CHUNK_SIZE] for i in range(0, len(items), PARALLEL_PARSE_CHUNK_SIZE)]
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            # map() yields chunk results in submission order, so the merge is deterministic.
+            for chunk_result in executor.map(_parse_filename_chunk, chunks, [precedence] * len(chunks)):
+                results.extend(chunk_result)
+    except (OSError, RuntimeError, ImportError):
+        # No usable process pool here (sandboxed or restricted interpreter); parse serially.
+        return _parse_filename_chunk(items, precedence)
+    return results
+
+# --- Video container probing ---
+MATROSKA_EXTENSIONS = {'.mkv', '.mka', '.mk3d', '.webm'}
+MP4_EXTENSIONS = {'.mp4', '.m4v', '.mov'}
+# Metadata elements larger than this are skipped instead of read.
+CONTAINER_MAX_ELEMENT_BYTES = 1 << 20
+# Stop looking for metadata after this many top-level elements/boxes.
+CONTAINER_MAX_TOP_LEVEL_ITEMS = 64
+
+# Matroska element IDs
+MKV_EBML = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEKHEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TITLE = 0x7BA9
+MKV_TAGS = 0x1254C367
+MKV_TAG = 0x7373
+MKV_TARGETS = 0x63C0
+MKV_TARGET_TYPE_VALUE = 0x68CA
+MKV_SIMPLE_TAG = 0x67C8
+MKV_TAG_NAME = 0x45A3
+MKV_TAG_STRING = 0x4487
+MKV_CLUSTER = 0x1F43B675
+
+_video_probe_cache = {}
+
+def _read_ebml_vint(f, keep_marker):
+    """Reads an EBML variable-length integer. Returns (value, is_unknown_size)."""
+    first = f.read(1)
+    if not first:
+        raise EOFError
+    length = 1
+    while length <= 8 and not first[0] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML integer")
+    data = first + f.read(length - 1)
+    if len(data) < length:
+        raise EOFError
+    value = int.from_bytes(data, 'big')
+    if keep_marker:
+        return value, False
+    value &= (1 << (7 * length)) - 1
+    return value, value == (1 << (7 * length)) - 1
+
+def _iter_ebml_children(f, end):
+    """
+    Yields (element_id, payload_start, payload_size) for the elements between the current
+    position and `end`, seeking over every payload. payload_size is None for unknown-size elements.
+    """
+    while end is None or f.tell() < end:
+        try:
+            element_id, _ = _read_ebml_vint(f, keep_marker=True)
+            size, unknown = _read_ebml_vint(f, keep_marker=False)
+        except EOFError:
+            return
+        start = f.tell()
+        yield element_id, start, None if unknown else size
+        if unknown:
+            return # Cannot skip an element of unknown size.
+        f.seek(start + size)
+
+def _parse_matroska_info(f, end, info):
+    timestamp_scale = 1000000
+    duration = None
+    for element_id, start, size in _iter_ebml_children(f, end):
+        if size is None:
+            break
+        if element_id == MKV_TIMESTAMP_SCALE:
+            timestamp_scale = int.from_bytes(f.read(size), 'big')
+        elif element_id == MKV_DURATION and size in (4, 8):
+            duration = struct.unpack('>f' if size == 4 else '>d', f.read(size))[0]
+        elif element_id == MKV_TITLE:
+            info['title'] = f.read(size).decode('utf-8', 'replace').strip('\x00 ')
+    if duration is not None:
+        info['duration'] = duration * timestamp_scale / 1e9
+
+def _parse_matroska_tags(f, end, info):
+    for element_id, start, size in _iter_ebml_children(f, end):
+        if element_id != MKV_TAG or size is None:
+            continue
+        target_type = 50 # Default target: episode/movie level
+        tags = {}
+        for child_id, child_start, child_size in _iter_ebml_children(f, start + size):
+            if child_size is None:
+                break
+            if child_id == MKV_TARGETS:
+                for target_id, target_start, target_size in _iter_ebml_children(f, child_start + child_size):
+                    if target_id == MKV_TARGET_TYPE_VALUE and target_size:
+                        target_type = int.from_bytes(f.read(target_size), 'big')
+            elif child_id == MKV_SIMPLE_TAG:
+                name = value = None
+                for tag_id, tag_start, tag_size in _iter_ebml_children(f, child_start + child_size):
+                    if tag_id == MKV_TAG_NAME:
+                        name = f.read(tag_size).decode('utf-8', 'replace').upper()
+                    elif tag_id == MKV_TAG_STRING:
+                        value = f.read(tag_size).decode('utf-8', 'replace').strip('\x00 ')
+                if name and value:
+                    tags[name] = value
+        if target_type == 50 and tags.get('PART_NUMBER'):
+            info['episode'] = tags['PART_NUMBER']
+
+def _probe_matroska(f):
+    """Reads the Info (and Tags) elements of a Matroska file, stopping at the first Cluster."""
+    info = {}
+    element_id, _ = _read_ebml_vint(f, keep_marker=True)
+    if element_id != MKV_EBML:
+        return info
+    size, _ = _read_ebml_vint(f, keep_marker=False)
+    f.seek(size, 1)
+    element_id, _ = _read_ebml_vint(f, keep_marker=True)
+    if element_id != MKV_SEGMENT:
+        return info
+    segment_size, unknown = _read_ebml_vint(f, keep_marker=False)
+    segment_start = f.tell()
+    segment_end = None if unknown else segment_start + segment_size
+
+    parsers = {MKV_INFO: _parse_matroska_info, MKV_TAGS: _parse_matroska_tags}
+    seek_positions = {}
+    for count, (element_id, start, size) in enumerate(_iter_ebml_children(f, segment_end)):
+        if count >= CONTAINER_MAX_TOP_LEVEL_ITEMS or element_id == MKV_CLUSTER or size is None:
+            break
+        if size > CONTAINER_MAX_ELEMENT_BYTES:
+            continue
+        if element_id == MKV_SEEKHEAD:
+            for seek_id, seek_start, seek_size in _iter_ebml_children(f, start + size):
+                if seek_id != MKV_SEEK or seek_size is None:
+                    continue
+                target_id = target_position = None
+                for entry_id, entry_start, entry_size in _iter_ebml_children(f, seek_start + seek_size):
+                    if entry_id == MKV_SEEK_ID:
+                        target_id = int.from_bytes(f.read(entry_size), 'big')
+                    elif entry_id == MKV_SEEK_POSITION:
+                        target_position = int.from_bytes(f.read(entry_size), 'big')
+                if target_id in parsers and target_position is not None:
+                    seek_positions.setdefault(target_id, segment_start + target_position)
+        elif element_id in parsers:
+            parsers.pop(element_id)(f, start + size, info)
+
+    # Tags are usually written after the media data; the SeekHead tells where.
+    for element_id, parser in parsers.items():
+        if element_id not in seek_positions:
+            continue
+        f.seek(seek_positions[element_id])
+        try:
+            found_id, _ = _read_ebml_vint(f, keep_marker=True)
+            size, unknown = _read_ebml_vint(f, keep_marker=False)
+        except (EOFError, ValueError):
+            continue # Stale SeekHead entry
+        if found_id == element_id and not unknown and size <= CONTAINER_MAX_ELEMENT_BYTES:
+            parser(f, f.tell() + size, info)
+    return info
+
+def _iter_mp4_boxes(f, end):
+    """Yields (box_type, payload_start, box_end) for the boxes up to `end`, seeking over every payload."""
+    while f.tell() + 8 <= end:
+        box_start = f.tell()
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+        elif size == 0: # Box extends to the end of its parent
+            size = end - box_start
+        payload_start = f.tell()
+        if size < payload_start - box_start:
+            return
+        yield box_type, payload_start, box_start + size
+        f.seek(box_start + size)
+
+def _read_mp4_item_data(f, end):
+    """Payload of the 'data' box inside an 'ilst' item."""
+    for box_type, start, box_end in _iter_mp4_boxes(f, end):
+        if box_type == b'data' and box_end - start <= CONTAINER_MAX_ELEMENT_BYTES:
+            f.seek(start + 8) # Skip type indicator and locale
+            return f.read(box_end - start - 8)
+    return None
+
+def _probe_mp4(f, file_size):
+    """Reads 'mvhd' and the iTunes-style metadata of an MP4 file. Media and sample tables are skipped."""
+    info = {}
+    for count, (box_type, start, end) in enumerate(_iter_mp4_boxes(f, file_size)):
+        if count >= CONTAINER_MAX_TOP_LEVEL_ITEMS:
+            break
+        if box_type != b'moov':
+            continue
+        for child_type, child_start, child_end in _iter_mp4_boxes(f, end):
+            if child_type == b'mvhd':
+                version = f.read(1)[0]
+                f.seek(child_start + (20 if version == 1 else 12))
+                timescale = struct.unpack('>I', f.read(4))[0]
+                duration = struct.unpack('>Q' if version == 1 else '>I', f.read(8 if version == 1 else 4))[0]
+                if timescale:
+                    info['duration'] = duration / timescale
+            elif child_type == b'udta':
+                for meta_type, meta_start, meta_end in _iter_mp4_boxes(f, child_end):
+                    if meta_type != b'meta':
+                        continue
+                    # 'meta' is a full box in MP4 but a plain box in QuickTime files.
+                    f.seek(meta_start + 4)
+                    if f.read(4) != b'hdlr':
+                        meta_start += 4
+                    f.seek(meta_start)
+                    for ilst_type, ilst_start, ilst_end in _iter_mp4_boxes(f, meta_end):
+                        if ilst_type != b'ilst':
+                            continue
+                        for item_type, item_start, item_end in _iter_mp4_boxes(f, ilst_end):
+                            if item_type == b'\xa9nam':
+                                data = _read_mp4_item_data(f, item_end)
+                                if data:
+                                    info['title'] = data.decode('utf-8', 'replace')
+                            elif item_type == b'tves':
+                                data = _read_mp4_item_data(f, item_end)
+                                if data:
+                                    info['episode'] = str(int.from_bytes(data, 'big'))
+        break
+    return info
+
+def probe_video_container(path):
+    """
+    Reads title, episode and duration (seconds) from the header of a Matroska or MP4 file.
+    Only element/box headers and the metadata itself are read, never the media data.
+    Results are cached by (path, size, mtime).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in MATROSKA_EXTENSIONS and ext not in MP4_EXTENSIONS:
+        return {}
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    cache_key = (path, st.st_size, st.st_mtime_ns)
+    if cache_key in _video_probe_cache:
+        return _video_probe_cache[cache_key]
+
+    try:
+        with open(path, 'rb') as f:
+            info = _probe_matroska(f) if ext in MATROSKA_EXTENSIONS else _probe_mp4(f, st.st_size)
+    except (OSError, EOFError, ValueError, IndexError, struct.error):
+        info = {}
+    if info.get('episode'):
+        info['episode'] = EpisodeId.parse(info['episode'])
+    elif info.get('title'):
+        info['episode'] = extract_episode_identifier(info['title'])
+    _video_probe_cache[cache_key] = info
+    return info
+
+# --- Title matching ---
+# Release tokens that are not part of a title: resolution, source, codecs, subtitle languages...
+RELEASE_TOKEN_PATTERN = re.compile(
+    r'(?i)\b(?:\d{3,4}[pi]|[248]k|uhd|fhd|hd|bd|bdrip|bdmv|blu-?ray|web|web-?dl|web-?rip|tv|tvrip|hdtv|dvd|dvdrip|remux|'
+    r'x26[45]|h\.?26[45]|hevc|avc|av1|aac|flac|ac3|e?ac-?3|dts|opus|[0-9]+bit|hi10p?|ma10p|hdr|sdr|'
+    r'chs|cht|gb|big5|jpsc|jptc|sc|tc|v\d)\b')
+# Where the episode number starts, most explicit form first. A bare number is the last resort.
+EPISODE_MARKER_PATTERNS = [re.compile(p) for p in (
+    r'(?i)\bS\d{1,2}E\d', r'\s-\s*\d', r'第[\d一二三四五六七八九十]', r'(?i)\b(?:EP?|Episode)\s?\d', r'(?:^|\s)\d{1,3}(?:\.\d)?(?=\s|$)')]
+# Titles that share fewer trigrams than this (Jaccard similarity) are different series.
+TITLE_MATCH_MIN_SIMILARITY = 0.5
+
+def normalize_title(name):
+    """
+    Reduces a subtitle or video filename to a comparable series title: full-width and
+    case folded, without extension, bracketed group/info tags, release tokens and
+    everything from the episode number on.
+    """
+    text = unicodedata.normalize('NFKC', name).casefold()
+    text = re.sub(r'(\.[a-z\d\-_&+]{2,15})?\.[a-z\d]{2,4}$', '', text)
+    untagged = re.sub(r'\[[^\]]*\]|\([^)]*\)|【[^】]*】', ' ', text)
+    if not re.search(r'\w', RELEASE_TOKEN_PATTERN.sub(' ', untagged)):
+        # "[Group][Title][01][1080p]": the title is the longest remaining tag after the group.
+        # "[Title][01][1080p]" has no group tag, so the first tag is only dropped if another is left.
+        tags = [RELEASE_TOKEN_PATTERN.sub(' ', re.sub(r'[._]', ' ', t)) for t in re.findall(r'[\[【]([^\]】]*)[\]】]', text)]
+        tags = [t for t in tags if re.search(r'[^\W\d_]', t)]
+        untagged = max(tags[1:] or tags, key=len) if tags else ''
+    untagged = untagged.replace('.', ' ').replace('_', ' ')
+    for pattern in EPISODE_MARKER_PATTERNS:
+        matches = list(pattern.finditer(untagged))
+        if matches:
+            untagged = untagged[:matches[-1].start()]
+            break
+    untagged = RELEASE_TOKEN_PATTERN.sub(' ', untagged)
+    return ' '.join(re.sub(r'[\W_]+', ' ', untagged).split())
 
+def _title_trigrams(title):
+    """Character trigrams of a title, ignoring spaces so 'tabi tabi' and 'tabitabi' agree."""
+    compact = title.replace(' ', '')
+    if len(compact) < 3:
+        return {compact} if compact else set()
+    return {compact[i:i + 3] for i in range(len(compact) - 2)}
 
-def get_language_from_filename(filename):
-    """Extracts language code from a filename."""
-    known_langs = {'ar', 'bg', 'ca', 'cs', 'da', 'de', 'el', 'en', 'es', 'fi', 'fr', 'hi', 'hu', 'id', 'is', 'it', 'ja', 'jp', 'ko', 'lt', 'lv', 'ms', 'my', 'nb', 'ne', 'nl', 'nn', 'pl', 'pt', 'ro', 'ru', 'sc', 'sk', 'sl', 'sv', 'tc', 'th', 'tl', 'tr', 'uk', 'ur', 'vi', 'zh', 'ara', 'ces', 'chs', 'cht', 'chi', 'cho', 'dan', 'deu', 'ell', 'eng', 'fil', 'fin', 'fra', 'heb', 'hun', 'hy', 'ind', 'isl', 'ita', 'jpn', 'kor', 'lat', 'nor', 'pol', 'por', 'ron', 'rus', 'slk', 'slv', 'spa', 'swe', 'tha', 'tur', 'ukr', 'und', 'vie', 'zho', 'zxx', 'ensc', 'entc', 'enjp', 'jpen', 'jpsc', 'jptc', 'scjp', 'scen', 'tcjp', 'tcen', 'zh-CN', 'zh-HK', 'zh-MO', 'zh-SG', 'zh-TW', 'chs-eng', 'cht-eng', 'de-AT', 'de-CH', 'en-AU', 'en-CA', 'en-GB', 'en-IE', 'en-NZ', 'en-US', 'en-ZA', 'en_sc', 'en_tc', 'en+sc', 'en+tc', 'es-419', 'es-LA', 'es-MX', 'es-ES', 'fr-BE', 'fr-CA', 'it-CH', 'nl-BE', 'pt-BR', 'pt-PT', 'sc-en', 'sc-jp', 'sr-Cyrl', 'sr-Latn', 'tc-en', 'tc-jp', 'zh-Hans', 'zh-Hant', 'chs&jpn', 'cht&jpn', 'eng&jpn', 'engsub', 'en-forced'}
-    # 如需增加对其他语言缩写的自动识别，请在此增补
-    lang_match = re.search(r'\.([a-zA-Z\d\-_&]{2,15})\.([a-zA-Z]{2,4})$', filename)
-    if lang_match and lang_match.group(1).lower() in known_langs:
-        return lang_match.group(1).lower()
-    return "default"
+class TrigramIndex:
+    """
+    Inverted index from title trigrams to the titles containing them.
+    A lookup only visits the titles that share at least one trigram with the query,
+    instead of comparing against every indexed name.
+    """
+    def __init__(self):
+        self.titles = []
+        self.title_ids = {}
+        self.title_grams = []
+        self.postings = {}
+
+    def add(self, title):
+        if title in self.title_ids:
+            return
+        title_id = len(self.titles)
+        grams = _title_trigrams(title)
+        self.titles.append(title)
+        self.title_ids[title] = title_id
+        self.title_grams.append(len(grams))
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(title_id)
+
+    def similarities(self, title):
+        """Jaccard similarity of `title` to every indexed title sharing a trigram with it."""
+        grams = _title_trigrams(title)
+        shared = {}
+        for gram in grams:
+            for title_id in self.postings.get(gram, ()):
+                shared[title_id] = shared.get(title_id, 0) + 1
+        return {self.titles[title_id]: count / (len(grams) + self.title_grams[title_id] - count)
+                for title_id, count in shared.items()}
+
+    def best_match(self, title, min_similarity=TITLE_MATCH_MIN_SIMILARITY):
+        """The indexed title most similar to `title`, or None if none is similar enough."""
+        scores = self.similarities(title)
+        if not scores:
+            return None
+        best = max(scores, key=lambda t: (scores[t], t))
+        return best if scores[best] >= min_similarity else None
+
+def pick_by_title(candidates, title, index):
+    """
+    Picks the (title, value) candidate whose title is most similar to `title`.
+    Returns None if there is no title to compare or the best candidates are equally similar.
+    """
+    if not title:
+        return None
+    scores = index.similarities(title)
+    ranked = sorted(candidates, key=lambda c: scores.get(c[0], 0.0), reverse=True)
+    if len(ranked) > 1 and scores.get(ranked[0][0], 0.0) == scores.get(ranked[1][0], 0.0):
+        return None
+    return ranked[0][1]
 
 def group_and_select_languages(file_paths):
     """
     Groups files by episode, determines if it's a movie or series, and selects languages.
     """
+    stage = EventStage('group', files=len(file_paths))
     episodes = {}
     language_codes = set()
-    for path in file_paths:
-        filename = os.path.basename(path)
+    filenames = [os.path.basename(path) for path in file_paths]
+    parsed = parse_filenames_batch(filenames, infer_episode_identifiers(file_paths))
+    for path, filename, (episode_id, lang, _) in zip(file_paths, filenames, parsed):
         if re.search(r'(?i)font', filename):
             continue 
         
-        episode_id = extract_episode_identifier(filename)
+        if not episode_id:
+            episode_id = identify_episode_from_header(path)
         if not episode_id:
             base_name_for_grouping = re.sub(r'(\.[a-zA-Z]{2,5})?\.[a-zA-Z]{2,4}$', '', filename)
-            episode_id = f"_SINGLE_{base_name_for_grouping}"
+            episode_id = EpisodeId.single(base_name_for_grouping)
 
-        lang = get_language_from_filename(filename)
+        if lang == "default" and CONFIG.get("SNIFF_CONTENT_LANGUAGE") == 1:
+            lang = sniff_content_language(path) or "default"
         if lang != "default":
             language_codes.add(lang)
         if episode_id not in episodes:
             episodes[episode_id] = {}
         episodes[episode_id][lang] = path
 
+    stage.finish(groups=len(episodes))
+    if _event_stream:
+        for episode_id, lang_files in episodes.items():
+            emit_event('group_detected', episode=None if episode_id.is_single else str(episode_id),
+                       movie=episode_id.is_single, name=episode_id.title, files=lang_files)
     if not episodes:
         return [], "default", False
 
-    has_series = any(not id.startswith("_SINGLE_") for id in episodes.keys())
-    has_movies = any(id.startswith("_SINGLE_") for id in episodes.keys())
+    group_lines = [f"{len(episodes)} 个分组, 语言: {', '.join(sorted(language_codes)) or 'default'}"]
+    for episode_id, lang_files in sorted(episodes.items(), key=lambda item: item[0].key):
+        group_lines.append(f"{episode_id}: {', '.join(sorted(lang_files))}")
+    set_ui_pane('groups', group_lines)
+
+    has_series = any(not id.is_single for id in episodes.keys())
+    has_movies = any(id.is_single for id in episodes.keys())
 
     if has_series and has_movies:
         print(f"{COLOR_RED}注意：文件中似乎混合了剧集和电影，将仅按剧集进行处理{COLOR_RESET}")
         movie_files_skipped = []
         for episode_id, lang_files in episodes.items():
-            if episode_id.startswith("_SINGLE_"):
+            if episode_id.is_single:
                 for path in lang_files.values():
                     movie_files_skipped.append(os.path.basename(path))
         if movie_files_skipped:
             print(f"{COLOR_RED}以下非剧集文件将会被忽略：{COLOR_RESET}")
             for filename in sorted(movie_files_skipped):
                 print(f"{COLOR_RED}- {filename}{COLOR_RESET}")
-        episodes = {k: v for k, v in episodes.items() if not k.startswith("_SINGLE_")}
+        episodes = {k: v for k, v in episodes.items() if not k.is_single}
     
     is_movie_mode = not has_series and has_movies
     
@@ -479,7 +2554,7 @@ def group_and_select_languages(file_paths):
             print(f"  {len(lang_list) + 1}. all")
             while True:
                 try:
-                    choice = int(input(f"请选择您想处理的语言 (1-{len(lang_list) + 1}): "))
+                    choice = int(read_line(f"请选择您想处理的语言 (1-{len(lang_list) + 1}): "))
                     if 1 <= choice <= len(lang_list):
                         chosen_lang_str = lang_list[choice - 1]
                         break
@@ -494,7 +2569,7 @@ def group_and_select_languages(file_paths):
             chosen_lang_str = "default"
 
     files_to_process = []
-    sorted_episodes = sorted(episodes.items(), key=lambda item: natural_sort_key(item[0]))
+    sorted_episodes = sorted(episodes.items(), key=lambda item: item[0].key)
 
     if chosen_lang_str == "all":
         for _, lang_files in sorted_episodes:
@@ -522,7 +2597,39 @@ def ask_add_suffix(lang_choice):
     )
     return choice == 2
 
-def get_target_format(is_movie_mode=False):
+# Episodes shown in the live preview while a target format is typed.
+TARGET_PREVIEW_ROWS = 5
+
+def preview_target_names(text, samples, add_suffix, is_movie_mode=False):
+    """
+    Preview lines for a partly typed target format. samples are (filename, episode id,
+    lang, ext) tuples parsed once up front; templates are cached per format string, so
+    each keystroke only compiles the new string and renders a few names.
+    """
+    if not text.strip():
+        return []
+    if not is_movie_mode and text.strip().lower() == 'sp':
+        return ["sp模式：将基于每集视频文件命名"]
+    cleaned_path = text.strip().strip('"\'')
+    target_format = os.path.basename(cleaned_path) if os.path.isfile(cleaned_path) else text
+    if re.search(r'[/\\:*\?"<>|]', target_format):
+        return [f"{COLOR_RED}格式包含非法字符{COLOR_RESET}"]
+    template = TargetTemplate.compile(os.path.splitext(target_format)[0], add_suffix, is_movie_mode)
+    if template is None:
+        return [f"{COLOR_RED}尚未识别到集数（例如 '01'）{COLOR_RESET}"]
+    return [f"  {filename} → {template.render(episode_id, lang, ext)}" for filename, episode_id, lang, ext in samples]
+
+def get_target_format(is_movie_mode=False, preview_files=None, add_suffix=False):
+    """
+    Asks for the target format. preview_files, the (path, lang) pairs to be renamed, enables
+    a live preview of the first few new names while typing.
+    """
+    samples = []
+    for old_path, lang in (preview_files or [])[:TARGET_PREVIEW_ROWS]:
+        filename = os.path.basename(old_path)
+        episode_id = None if is_movie_mode else identify_episode(old_path)
+        if is_movie_mode or episode_id:
+            samples.append((filename, episode_id, lang, "." + filename.split('.')[-1]))
     print("\n" + "-" * 50)
     if is_movie_mode:
         print("请输入目标视频的文件名（也可以直接拖入目标视频文件）")
@@ -532,7 +2639,8 @@ def get_target_format(is_movie_mode=False):
         print("或者，您可以输入'sp'进入特殊模式（将基于每集视频文件命名，用于处理每集有不同文件名的剧集）")
     print("-" * 50)
     while True:
-        target_input = input("目标格式: ")
+        target_input = read_line_with_preview(
+            "目标格式: ", lambda text: preview_target_names(text, samples, add_suffix, is_movie_mode))
         
         if not is_movie_mode and target_input.lower() == 'sp': 
             return 'sp'
@@ -554,171 +2662,730 @@ def get_target_format(is_movie_mode=False):
             
         return os.path.splitext(target_format)[0]
 
-def generate_rename_plan(files_with_lang, target_format, add_suffix, is_movie_mode=False):
-    rename_plan = []
+# --- Duration-based pairing ---
+# Bytes read from the end of a subtitle to find its last timestamp; doubled until one is found.
+SUBTITLE_TAIL_BYTES = 16384
+SUBTITLE_TAIL_MAX_BYTES = 262144
+# A video may run this much longer than its subtitles (ending songs, previews).
+DURATION_MATCH_TOLERANCE = 180.0
+# Subtitles may end slightly after the video does.
+DURATION_OVERRUN_SLACK = 2.0
+# Videos closer in length than this cannot be told apart by duration.
+DURATION_AMBIGUITY_SECONDS = 1.0
+
+ASS_END_TIME_PATTERN = re.compile(rb'Dialogue:\s*(?:Marked=)?\d+,\d+:\d{2}:\d{2}[.:]\d{2},(\d+):(\d{2}):(\d{2})[.:](\d{2})')
+SRT_END_TIME_PATTERN = re.compile(rb'-->\s*(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})')
+
+_subtitle_span_cache = {}
+
+def read_subtitle_span(path):
+    """
+    Returns the end time (seconds) of the last timed line in a subtitle, or None.
+    Only the tail of the file is read; timestamps are ASCII, so no full decode is needed.
+    """
+    try:
+        cache_key = _file_cache_key(path)
+        if cache_key in _subtitle_span_cache:
+            return _subtitle_span_cache[cache_key]
+        size = os.path.getsize(path)
+        span = None
+        with open(path, 'rb') as f:
+            bom = f.read(2)
+            utf16 = {codecs.BOM_UTF16_LE: 'utf-16-le', codecs.BOM_UTF16_BE: 'utf-16-be'}.get(bom)
+            tail_bytes = SUBTITLE_TAIL_BYTES
+            while span is None:
+                start = max(0, size - tail_bytes)
+                if utf16:
+                    start = max(2, start - start % 2)
+                f.seek(start)
+                tail = f.read()
+                if utf16:
+                    tail = tail.decode(utf16, 'replace').encode('ascii', 'replace')
+                ends = []
+                for match in ASS_END_TIME_PATTERN.finditer(tail):
+                    h, m, sec, cs = (int(g) for g in match.groups())
+                    ends.append(h * 3600 + m * 60 + sec + cs / 100)
+                for match in SRT_END_TIME_PATTERN.finditer(tail):
+                    h, m, sec, ms = (int(g or 0) for g in match.groups())
+                    ends.append(h * 3600 + m * 60 + sec + ms / 1000)
+                if ends:
+                    span = max(ends)
+                if start == 0 or tail_bytes >= SUBTITLE_TAIL_MAX_BYTES:
+                    break
+                tail_bytes *= 2
+    except OSError:
+        return None
+    _subtitle_span_cache[cache_key] = span
+    return span
+
+def pair_by_duration(subtitle_groups, video_paths):
+    """
+    Pairs subtitle groups ({key: [paths]}) with videos by comparing the subtitles' last
+    timestamp with the video durations from the container header.
+    The assignment is solved for the whole batch at once: both sides are sorted by length
+    and matched in order with a dynamic program that minimizes the total time gap,
+    leaving out pairs that do not fit. Pairs whose video cannot be told apart from
+    another video by length are dropped. Returns {key: video_path}.
+    """
+    subtitles = []
+    for key, paths in subtitle_groups.items():
+        spans = [span for span in (read_subtitle_span(path) for path in paths) if span is not None]
+        if spans:
+            subtitles.append((max(spans), key))
+    videos = []
+    for v_path in video_paths:
+        duration = probe_video_container(v_path).get('duration')
+        if duration:
+            videos.append((duration, v_path))
+    if not subtitles or not videos:
+        return {}
+    subtitles.sort()
+    videos.sort()
+
+    def pair_cost(span, duration):
+        gap = duration - span
+        return gap if -DURATION_OVERRUN_SLACK <= gap <= DURATION_MATCH_TOLERANCE else None
+
+    # best[j]: lowest cost using the subtitles seen so far and the first j videos.
+    # Leaving a subtitle or a video out costs DURATION_MATCH_TOLERANCE / nothing.
+    n, m = len(subtitles), len(videos)
+    skip_cost = DURATION_MATCH_TOLERANCE
+    best = [0.0] * (m + 1)
+    choices = []
+    for i in range(n):
+        span = subtitles[i][0]
+        row = [best[0] + skip_cost] + [0.0] * m
+        choice = bytearray(m + 1) # 0 = skip subtitle, 1 = skip video, 2 = pair
+        for j in range(1, m + 1):
+            row[j], choice[j] = best[j] + skip_cost, 0
+            if row[j - 1] < row[j]:
+                row[j], choice[j] = row[j - 1], 1
+            cost = pair_cost(span, videos[j - 1][0])
+            if cost is not None and best[j - 1] + abs(cost) < row[j]:
+                row[j], choice[j] = best[j - 1] + abs(cost), 2
+        best = row
+        choices.append(choice)
+
+    matches = {}
+    i, j = n, m
+    while i > 0 and j > 0:
+        choice = choices[i - 1][j]
+        if choice == 2:
+            neighbours = [videos[k][0] for k in (j - 2, j) if 0 <= k < m]
+            if all(abs(d - videos[j - 1][0]) >= DURATION_AMBIGUITY_SECONDS for d in neighbours):
+                matches[subtitles[i - 1][1]] = videos[j - 1][1]
+            i, j = i - 1, j - 1
+        elif choice == 1:
+            j -= 1
+        else:
+            i -= 1
+    return matches
+
+# --- Release CRC32 ---
+CRC32_TAG_PATTERN = re.compile(r'\[([0-9A-Fa-f]{8})\]')
+# Large chunks keep zlib (which releases the GIL) busy; one worker thread per file.
+CRC32_CHUNK_BYTES = 16 * 1024 * 1024
+CRC32_WORKERS = min(4, os.cpu_count() or 1)
+# Checksums are kept between runs, so a multi-GB release is only ever hashed once.
+CRC32_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.subrename', 'crc32.json')
+# Oldest entries are dropped beyond this, so files that are long gone don't pile up.
+CRC32_CACHE_MAX_ENTRIES = 100000
+
+_crc32_cache = None # "device:inode:size:mtime" -> checksum, loaded on first use
+_crc32_cache_dirty = False
+
+def load_crc32_cache():
+    """The checksum cache, read from CRC32_CACHE_PATH once per session."""
+    global _crc32_cache
+    if _crc32_cache is None:
+        try:
+            with open(CRC32_CACHE_PATH, encoding='utf-8') as f:
+                _crc32_cache = json.load(f)
+        except FileNotFoundError:
+            _crc32_cache = {}
+        except (OSError, ValueError) as e:
+            print(f"{COLOR_RED}警告：无法从 '{CRC32_CACHE_PATH}' 读取 CRC32 缓存：{e}{COLOR_RESET}")
+            _crc32_cache = {}
+        if not isinstance(_crc32_cache, dict):
+            _crc32_cache = {}
+    return _crc32_cache
+
+def save_crc32_cache():
+    """Writes new checksums through a temporary file, so an interrupted save never truncates the cache."""
+    global _crc32_cache_dirty
+    if not _crc32_cache_dirty:
+        return
+    cache = load_crc32_cache()
+    entries = list(cache.items())[-CRC32_CACHE_MAX_ENTRIES:]
+    temp_path = CRC32_CACHE_PATH + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(CRC32_CACHE_PATH), exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(entries), f)
+        os.replace(temp_path, CRC32_CACHE_PATH)
+        _crc32_cache_dirty = False
+    except OSError as e:
+        print(f"{COLOR_RED}警告：无法将 CRC32 缓存保存到 '{CRC32_CACHE_PATH}'：{e}{COLOR_RESET}")
+
+def get_crc32_tag(filename):
+    """Returns the release CRC32 tag of a filename (upper case), or None."""
+    tags = CRC32_TAG_PATTERN.findall(filename)
+    return tags[-1].upper() if tags else None
+
+def compute_crc32(path):
+    """
+    CRC32 of a file as an 8-digit hex string, computed over a memory map of the file.
+    Results are cached by (inode, size, mtime), also across runs (see save_crc32_cache).
+    Returns None if the file cannot be read.
+    """
+    global _crc32_cache_dirty
+    cache = load_crc32_cache()
+    try:
+        st = os.stat(path)
+        cache_key = f"{st.st_dev}:{st.st_ino or os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+        if cache_key in cache:
+            return cache[cache_key]
+        crc = 0
+        if st.st_size:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(view), CRC32_CHUNK_BYTES):
+                        crc = zlib.crc32(view[offset:offset + CRC32_CHUNK_BYTES], crc)
+    except (OSError, ValueError):
+        return None
+    checksum = f"{crc & 0xFFFFFFFF:08X}"
+    cache[cache_key] = checksum
+    _crc32_cache_dirty = True
+    return checksum
+
+def build_crc32_index(video_paths, verify=False, wanted_tags=None):
+    """
+    Maps release CRC32 tags to video paths. With verify=True, the videos are checksummed
+    in parallel and files that do not match their tag are left out. wanted_tags limits the
+    index (and so the checksumming) to the tags the subtitles actually name.
+    """
+    tagged = {}
+    for v_path in video_paths:
+        tag = get_crc32_tag(os.path.basename(v_path))
+        if tag and (wanted_tags is None or tag in wanted_tags):
+            tagged[v_path] = tag
+
+    if verify and tagged:
+        print(f"\n正在校验 {len(tagged)} 个视频文件的CRC32...")
+        load_crc32_cache()
+        with ThreadPoolExecutor(max_workers=CRC32_WORKERS) as pool:
+            checksums = dict(zip(tagged, pool.map(compute_crc32, tagged)))
+        save_crc32_cache()
+        for v_path, tag in list(tagged.items()):
+            if checksums[v_path] is None:
+                print(f"{COLOR_RED}错误：无法读取 '{os.path.basename(v_path)}' 以校验CRC32{COLOR_RESET}")
+                del tagged[v_path]
+            elif checksums[v_path] != tag:
+                print(f"{COLOR_RED}警告：'{os.path.basename(v_path)}' 的CRC32不一致（实际为 {checksums[v_path]}），将不会按CRC32匹配{COLOR_RESET}")
+                del tagged[v_path]
+        print(f"{COLOR_GREEN}{len(tagged)} 个视频文件通过CRC32校验{COLOR_RESET}")
+
+    return {tag: v_path for v_path, tag in tagged.items()}
+
+# --- Target templates ---
+# Episode placeholder patterns for target formats, most specific first.
+TARGET_PLACEHOLDER_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'(?i)S\d{1,2}E(\d{1,3}(?:\.\d(?!\d))?)',
+    r'第(\d{1,3}(?:\.\d)?)(?:集|話|话)',
+    r'(\d{1,3}(?:\.\d)?)\s*화',
+    r'(?i)(?:Episodio|Episódio|Episod)\s*(\d{1,3}(?:\.\d)?)',
+    r'(?i)(?:ตอน(?:ที่)?)\s*(\d{1,3}(?:\.\d)?)',
+    r'(?i)(?:Эпизод|Серия)\s*(\d{1,3}(?:\.\d)?)',
+    r'(?i)Épisode\s*(\d{1,3}(?:\.\d)?)',
+    r'-\s*(\d{1,3}(?:\.\d)?)',
+    r'[\s\._]EP(\d{1,3}(?:\.\d)?)',
+    r'\[(\d{1,3}(?:\.\d)?(?:v\d)?)\]',
+    r'\s(\d{1,3}(?:\.\d)?)\b(?!p|i)',
+)]
+
+_target_template_cache = {}
+
+class TargetTemplate:
+    """
+    A target filename compiled once: the text before and after the episode number, the
+    number width, how specials are joined and whether language suffixes are added.
+    Rendering a name is plain string joining. Templates without an episode field (movie
+    and sp mode) render a fixed base name. to_dict()/from_dict() save and reload a template.
+    """
+    def __init__(self, prefix, suffix='', width=None, compact_specials=False, add_suffix=False):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.width = width
+        self.compact_specials = compact_specials
+        self.add_suffix = add_suffix
+
+    @classmethod
+    def compile(cls, target_format, add_suffix=False, is_movie_mode=False):
+        """Template for a target format, or None if no episode placeholder can be found in it."""
+        cache_key = (target_format, bool(add_suffix), bool(is_movie_mode))
+        if cache_key in _target_template_cache:
+            return _target_template_cache[cache_key]
+
+        if is_movie_mode:
+            template = cls(target_format, add_suffix=add_suffix)
+        else:
+            best_match = None
+            for pattern in TARGET_PLACEHOLDER_PATTERNS:
+                matches = list(pattern.finditer(target_format))
+                if matches:
+                    best_match = matches[-1]
+                    break
+
+            if not best_match:
+                for match in reversed(list(re.finditer(r'(\d+\.?\d*)', target_format))):
+                    end_pos = match.end()
+                    if end_pos == len(target_format) or not target_format[end_pos].isalpha():
+                        best_match = match
+                        break
+            if not best_match:
+                return None
+
+            group_index = len(best_match.groups())
+            start, end = best_match.span(group_index)
+            template = cls(target_format[:start], target_format[end:],
+                           # Width of the integer part only; '[01v2]' pads to 2 digits, not 4.
+                           width=len(re.match(r'\d+', best_match.group(group_index)).group()),
+                           # If compact (test1), keep compact (testOVA1).
+                           # If spaced/symbol (test 01, [01]), force space (test OVA 01, [OVA 01]).
+                           compact_specials=start > 0 and target_format[start - 1].isalnum(),
+                           add_suffix=add_suffix)
+        _target_template_cache[cache_key] = template
+        return template
+
+    def format_episode(self, episode_id):
+        """Episode id padded to the template's width; specials keep their prefix (OVA 01)."""
+        return episode_id.format(self.width, '' if self.compact_specials else ' ')
+
+    def render(self, episode_id=None, lang_code='default', ext=''):
+        """New filename for one subtitle."""
+        base = self.prefix if self.width is None else self.prefix + self.format_episode(episode_id) + self.suffix
+        if self.add_suffix and lang_code != 'default':
+            return f"{base}.{lang_code}{ext}"
+        return base + ext
+
+    def to_dict(self):
+        return {'prefix': self.prefix, 'suffix': self.suffix, 'width': self.width,
+                'compact_specials': self.compact_specials, 'add_suffix': self.add_suffix}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['prefix'], data.get('suffix', ''), data.get('width'),
+                   bool(data.get('compact_specials')), bool(data.get('add_suffix')))
+
+def _video_based_filename(video_path, old_path, lang_code, add_suffix):
+    """New subtitle filename taken from a video's filename (sp mode)."""
+    video_basename = os.path.splitext(os.path.basename(video_path))[0]
+    base_ext = "." + os.path.basename(old_path).split('.')[-1]
+    return TargetTemplate(video_basename, add_suffix=add_suffix).render(lang_code=lang_code, ext=base_ext)
+
+def generate_rename_plan(files_with_lang, target_format, add_suffix, is_movie_mode=False, video_paths=None):
+    rename_plan = RenamePlan()
     
     if is_movie_mode:
+        template = TargetTemplate.compile(target_format, add_suffix, is_movie_mode=True)
         for old_path, lang_code in files_with_lang:
             base_ext = "." + old_path.split('.')[-1]
-            new_filename = f"{target_format}.{lang_code}{base_ext}" if add_suffix and lang_code != 'default' else target_format + base_ext
-            rename_plan.append((old_path, new_filename))
+            rename_plan.add(old_path, template.render(lang_code=lang_code, ext=base_ext), lang_code, 'movie')
         return rename_plan
 
     if target_format != 'sp':
-        best_match = None
-        patterns = [
-            r'(?i)S\d{1,2}E(\d{1,3}(?:\.\d)?)',
-            r'第(\d{1,3}(?:\.\d)?)(?:集|話|话)',
-            r'(\d{1,3}(?:\.\d)?)\s*화',
-            r'(?i)(?:Episodio|Episódio|Episod)\s*(\d{1,3}(?:\.\d)?)',
-            r'(?i)(?:ตอน(?:ที่)?)\s*(\d{1,3}(?:\.\d)?)',
-            r'(?i)(?:Эпизод|Серия)\s*(\d{1,3}(?:\.\d)?)',
-            r'(?i)Épisode\s*(\d{1,3}(?:\.\d)?)',
-            r'-\s*(\d{1,3}(?:\.\d)?)',
-            r'[\s\._]EP(\d{1,3}(?:\.\d)?)',
-            r'\[(\d{1,3}(?:\.\d)?(?:v\d)?)\]',
-            r'\s(\d{1,3}(?:\.\d)?)\b(?!p|i)',
-        ]
-        
-        for pattern in patterns:
-            matches = list(re.finditer(pattern, target_format, re.IGNORECASE))
-            if matches:
-                best_match = matches[-1]
-                break
-        
-        if not best_match:
-            all_numbers = list(re.finditer(r'(\d+\.?\d*)', target_format))
-            for match in reversed(all_numbers):
-                end_pos = match.end()
-                if end_pos == len(target_format) or not target_format[end_pos].isalpha():
-                    best_match = match
-                    break
-        
-        if not best_match:
+        template = TargetTemplate.compile(target_format, add_suffix)
+        if template is None:
             print(f"{COLOR_RED}错误：未能在目标格式中识别到集数{COLOR_RESET}")
             print(f"{COLOR_RED}目标格式: '{target_format}'{COLOR_RESET}")
-            return []
-
-        placeholder_group_index = len(best_match.groups())
-        placeholder_number_part = best_match.group(placeholder_group_index)
-        
-        padding = len(placeholder_number_part.split('.')[0]) if '.' in placeholder_number_part else len(placeholder_number_part)
-        start, end = best_match.span(placeholder_group_index)
-
-        # Check if the character immediately preceding the number is alphanumeric
-        prev_char_is_alnum = False
-        if start > 0 and target_format[start-1].isalnum():
-            prev_char_is_alnum = True
+            return RenamePlan()
 
         for old_path, lang_code in files_with_lang:
             old_filename = os.path.basename(old_path)
             base_ext = "." + old_filename.split('.')[-1]
-            episode_id = extract_episode_identifier(old_filename)
+            episode_id = identify_episode(old_path)
             if not episode_id: continue
-            
-            special_match = re.match(r'([A-Z]+)(\d+\.?\d*)', episode_id, re.IGNORECASE)
-            if special_match:
-                prefix = special_match.group(1)
-                num_part = special_match.group(2)
-                try:
-                    formatted_num = f"{int(float(num_part)):0{padding}d}"
-                    
-                    # Logic: If compact (test1), keep compact (testOVA1). 
-                    # If spaced/symbol (test 01, [01]), force space (test OVA 01, [OVA 01]).
-                    if prev_char_is_alnum:
-                        formatted_episode_id = f"{prefix}{formatted_num}"
-                    else:
-                        formatted_episode_id = f"{prefix} {formatted_num}"
-                        
-                except ValueError:
-                    formatted_episode_id = episode_id
-            else:
-                try:
-                    if '.' in episode_id:
-                        integer_part, decimal_part = episode_id.split('.')
-                        formatted_episode_id = f"{int(integer_part):0{padding}d}.{decimal_part}"
-                    else:
-                        formatted_episode_id = f"{int(episode_id):0{padding}d}"
-                except ValueError:
-                    formatted_episode_id = episode_id
-            
-            new_filename_base = target_format[:start] + formatted_episode_id + target_format[end:]
-            new_filename = f"{new_filename_base}.{lang_code}{base_ext}" if add_suffix and lang_code != 'default' else new_filename_base + base_ext
-            rename_plan.append((old_path, new_filename))
+            rename_plan.add(old_path, template.render(episode_id, lang_code, base_ext), lang_code, 'template')
 
     else: # 'sp' mode
         video_prompt = "请拖入目标文件，然后按回车键："
-        cleaned_video_paths = get_files_from_user(video_prompt)
+        cleaned_video_paths = video_paths or get_files_from_user(video_prompt)
         
         if cleaned_video_paths == 'restart':
             return 'restart'
 
+        if cleaned_video_paths:
+            # Subtitles and fonts dropped with the videos must not be paired with themselves.
+            video_files = [v for v in cleaned_video_paths if os.path.splitext(v)[1].lower() in VIDEO_EXTENSIONS]
+            if len(video_files) < len(cleaned_video_paths):
+                print(f"{COLOR_RED}已忽略 {len(cleaned_video_paths) - len(video_files)} 个非视频文件。{COLOR_RESET}")
+            cleaned_video_paths = video_files
+
         if not cleaned_video_paths:
-            print(f"\n{COLOR_RED}错误: 未找到视频文件 正在停止...{COLOR_RESET}")
+            logger.error("错误: 未找到视频文件 正在停止...", extra={'blank_line': True})
             return None
+        _session_choices["SP_VIDEO_DIRS"] = sorted({os.path.dirname(os.path.abspath(v)) for v in cleaned_video_paths})
+
         video_map = {}
-        for v_path in cleaned_video_paths:
+        unnumbered_videos = []
+        title_index = TrigramIndex()
+        for v_path, inferred_id in zip(cleaned_video_paths, infer_episode_identifiers(cleaned_video_paths)):
             v_filename = os.path.basename(v_path)
-            episode_id = extract_episode_identifier(v_filename)
-            if episode_id: video_map[episode_id] = v_path
-            else: print(f"{COLOR_RED}警告：无法确定剧集 '{v_filename}' 集数ID，它将被忽略\n（请附上字幕及视频文件名，并在提交issue中描述下出现过程，感谢您的协助，它将会在未来版本修复）{COLOR_RESET}")
-
+            episode_id = inferred_id or extract_episode_identifier(v_filename)
+            if not episode_id:
+                # Fall back to the title/episode metadata in the container header.
+                episode_id = probe_video_container(v_path).get('episode')
+            if episode_id:
+                # Several series in one video folder can share an episode number.
+                video_map.setdefault(episode_id, []).append((normalize_title(v_filename), v_path))
+                if episode_id.season is not None:
+                    # Also found by subtitles that leave the season out ("- 03" for S01E03).
+                    video_map.setdefault(episode_id.without_season(), []).append((normalize_title(v_filename), v_path))
+                title_index.add(normalize_title(v_filename))
+            else: unnumbered_videos.append(v_path)
+
+        crc_map = {}
+        if CONFIG.get("SP_CRC32_MODE") in (1, 2):
+            subtitle_tags = {get_crc32_tag(os.path.basename(path)) for path, _ in files_with_lang}
+            crc_map = build_crc32_index(cleaned_video_paths, verify=CONFIG.get("SP_CRC32_MODE") == 2,
+                                        wanted_tags=subtitle_tags - {None})
+
+        used_videos = set()
+        unmatched = {}
         for old_path, lang_code in files_with_lang:
             old_filename = os.path.basename(old_path)
-            base_ext = "." + old_filename.split('.')[-1]
-            episode_id = extract_episode_identifier(old_filename)
-            if episode_id in video_map:
-                video_basename = os.path.splitext(os.path.basename(video_map[episode_id]))[0]
-                new_filename = f"{video_basename}.{lang_code}{base_ext}" if add_suffix and lang_code != 'default' else video_basename + base_ext
-                rename_plan.append((old_path, new_filename))
+            crc_tag = get_crc32_tag(old_filename) if crc_map else None
+            if crc_tag in crc_map:
+                # The subtitle names its exact release (e.g. TV vs. BD), which beats the episode number.
+                rename_plan.add(old_path, _video_based_filename(crc_map[crc_tag], old_path, lang_code, add_suffix), lang_code, 'crc32')
+                used_videos.add(crc_map[crc_tag])
+                log_file_event('match', logging.INFO, "按CRC32匹配: '%s' → '%s'", old_path, crc_map[crc_tag],
+                               source=old_path, video=crc_map[crc_tag], strategy='crc32')
+                continue
+            episode_id = identify_episode(old_path)
+            candidates = video_map.get(episode_id) or (video_map.get(episode_id.without_season(), []) if episode_id else [])
+            if len(candidates) > 1:
+                v_path = pick_by_title(candidates, normalize_title(old_filename), title_index)
+                if not v_path:
+                    log_file_event('match', logging.WARNING, "警告：有 %d 个视频的剧集 ID 均为 '%s'，且没有一个与 '%s' 的标题更匹配",
+                                   len(candidates), episode_id, old_filename, source=old_path, episode=episode_id,
+                                   videos=[c[1] for c in candidates])
+            else:
+                v_path = candidates[0][1] if candidates else None
+            if v_path:
+                rename_plan.add(old_path, _video_based_filename(v_path, old_path, lang_code, add_suffix), lang_code, 'episode')
+                used_videos.add(v_path)
+                log_file_event('match', logging.INFO, "按集数匹配: '%s' → '%s'", old_path, v_path,
+                               source=old_path, video=v_path, strategy='episode')
+            elif episode_id:
+                # A numbered subtitle without its video is missing that episode; pairing it by
+                # length with another episode's video would give it the wrong name.
+                if not candidates:
+                    log_file_event('match', logging.WARNING, "警告：未找到与剧集 ID 为 '%s' 的字幕所匹配视频文件 跳过...", episode_id,
+                                   source=old_path, episode=episode_id)
+                count_metric('subrename_unmatched_subtitles_total')
             else:
-                print(f"{COLOR_RED}警告：未找到与剧集 ID 为 '{episode_id}' 的字幕所匹配视频文件 跳过...{COLOR_RESET}")
+                # Language versions of one episode share a video, so they are paired as a group.
+                group_key = re.sub(r'(\.[a-zA-Z]{2,5})?\.[a-zA-Z]{2,4}$', '', old_filename)
+                unmatched.setdefault(group_key, []).append((old_path, lang_code))
+
+        # Duration is the last resort, for when neither side has a usable episode number.
+        duration_matches = {}
+        if unmatched:
+            spare_videos = [v for v in unnumbered_videos if v not in used_videos]
+            duration_matches = pair_by_duration({key: [entry[0] for entry in entries] for key, entries in unmatched.items()}, spare_videos)
+
+        for group_key, entries in unmatched.items():
+            v_path = duration_matches.get(group_key)
+            for old_path, lang_code in entries:
+                if v_path:
+                    log_file_event('match', logging.INFO, "按时长匹配: '%s' → '%s'", old_path, v_path,
+                                   source=old_path, video=v_path, strategy='duration')
+                    rename_plan.add(old_path, _video_based_filename(v_path, old_path, lang_code, add_suffix), lang_code, 'duration')
+                else:
+                    log_file_event('match', logging.WARNING, "警告：无法确定字幕 '%s' 的集数ID，且没有时长相符的无集数视频 跳过...",
+                                   os.path.basename(old_path), source=old_path)
+                    count_metric('subrename_unmatched_subtitles_total')
+
+        paired_videos = used_videos | set(duration_matches.values())
+        for v_path in unnumbered_videos:
+            if v_path not in paired_videos:
+                log_file_event('match', logging.WARNING, "警告：无法确定剧集 '%s' 集数ID，它将被忽略", os.path.basename(v_path),
+                               video=v_path)
+        if duration_matches:
+            logger.info("按时长为 %d 个字幕匹配了视频", sum(1 for entry in rename_plan if entry.strategy == 'duration'))
     return rename_plan
 
-def execute_rename_plan(rename_plan):
+# Characters per read/write when streaming a converted subtitle.
+TRANSCODE_CHUNK_CHARS = 65536
+
+def copy_subtitle(src, dst):
     """
-    Executes the rename plan and returns a list of target directories.
+    Copies a subtitle file, converting it to UTF-8 on the fly if CONVERT_TO_UTF8 is set.
+    The source encoding is detected from a small sample (see read_encoding_sample) and the
+    file is then streamed through the decoder in a single pass. Returns True if the file
+    was converted.
     """
-    if not rename_plan:
-        print(f"\n{COLOR_RED}未执行重命名{COLOR_RESET}")
-        return None, 1
-        
-    # Sort by directory first, then by new filename naturally
-    rename_plan.sort(key=lambda item: (os.path.dirname(item[0]), natural_sort_key(item[1])))
+    if CONFIG.get("CONVERT_TO_UTF8") != 1 or os.path.splitext(src)[1].lower() not in TEXT_SUBTITLE_EXTENSIONS:
+        shutil.copy2(src, dst)
+        return False
 
-    clear_screen()
-    print("字幕文件将按照以下格式重命名，请确认：")
-    print("=" * 60)
-    
+    encoding = detect_text_encoding(read_encoding_sample(src))
+    had_bom = encoding in ('utf-8-sig', 'utf-16')
+    write_bom = had_bom if CONFIG.get("OUTPUT_BOM") not in (1, 2) else CONFIG.get("OUTPUT_BOM") == 2
+    newline = {'crlf': '\r\n', 'lf': '\n'}.get(str(CONFIG.get("OUTPUT_LINE_ENDING")).lower())
+
+    # Nothing to convert (or not a text file): a plain copy is cheaper.
+    if encoding is None or (encoding in ('utf-8', 'utf-8-sig') and write_bom == had_bom and newline is None):
+        shutil.copy2(src, dst)
+        return False
+
+    try:
+        # newline='' on both sides keeps line endings untouched; otherwise the reader
+        # normalizes them to '\n' and the writer emits the configured ending.
+        with open(src, 'r', encoding=encoding, newline=None if newline else '') as fin, \
+             open(dst, 'w', encoding='utf-8-sig' if write_bom else 'utf-8', newline=newline or '') as fout:
+            shutil.copyfileobj(fin, fout, TRANSCODE_CHUNK_CHARS)
+    except UnicodeDecodeError:
+        # The sample was misleading; keep the original bytes rather than a damaged file.
+        log_file_event('copy', logging.WARNING, "警告：无法将 '%s' 从 %s 编码转换，已按原样复制", os.path.basename(src), encoding,
+                       source=src, target=dst)
+        shutil.copy2(src, dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+# --- Plan review ---
+class PlanEntry:
+    """
+    One planned copy: source file, new filename, language code and how the name was found
+    (a key of PLAN_STRATEGY_LABELS). Folders are indexes into the plan's folder table.
+    """
+    __slots__ = ('plan', 'dir_index', 'basename', 'new_name', 'lang', 'strategy', 'target_dir_index')
+
+    def __init__(self, plan, dir_index, basename, new_name, lang, strategy, target_dir_index=None):
+        self.plan = plan
+        self.dir_index = dir_index
+        self.basename = basename
+        self.new_name = new_name
+        self.lang = lang
+        self.strategy = strategy
+        self.target_dir_index = target_dir_index
+
+    @property
+    def folder(self):
+        return self.plan.folders[self.dir_index]
+
+    @property
+    def old_path(self):
+        return os.path.join(self.plan.folders[self.dir_index], self.basename)
+
+    @property
+    def target_dir(self):
+        """The folder the new file must go to (library mode), or None to ask for the save location."""
+        return None if self.target_dir_index is None else self.plan.folders[self.target_dir_index]
+
+class RenamePlan:
+    """
+    The planned copies of one batch. Every folder path is stored once in a table that the
+    entries refer to by index, and language codes are interned, so a library-wide plan
+    costs little more than its filenames.
+    """
+    def __init__(self):
+        self.folders = []
+        self.folder_indexes = {}
+        self.entries = []
+        self._sources = None # folder index -> source basenames, built on the first lookup
+
+    def _folder_index(self, folder):
+        index = self.folder_indexes.get(folder)
+        if index is None:
+            index = self.folder_indexes[folder] = len(self.folders)
+            self.folders.append(folder)
+        return index
+
+    def add(self, old_path, new_name, lang, strategy, target_dir=None):
+        folder, basename = os.path.split(old_path)
+        target_dir_index = None if target_dir is None else self._folder_index(target_dir)
+        self.entries.append(PlanEntry(self, self._folder_index(folder), basename, new_name,
+                                      sys.intern(lang), strategy, target_dir_index))
+        self._sources = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __contains__(self, path):
+        """Whether `path` is the source file of a planned copy."""
+        if self._sources is None:
+            self._sources = {}
+            for entry in self.entries:
+                self._sources.setdefault(entry.dir_index, set()).add(entry.basename)
+        folder, basename = os.path.split(path)
+        return basename in self._sources.get(self.folder_indexes.get(folder), ())
+
+    def sort(self):
+        """
+        Sorts by source folder, then naturally by new filename. Entries are bucketed by
+        folder index, so only the folder table is sorted by path and each name key is
+        computed once and only compared within its own folder.
+        """
+        by_folder = {}
+        for entry in self.entries:
+            by_folder.setdefault(entry.dir_index, []).append(entry)
+        self.entries = []
+        for index in sorted(by_folder, key=self.folders.__getitem__):
+            folder_entries = by_folder[index]
+            folder_entries.sort(key=lambda entry: natural_sort_key(entry.new_name))
+            self.entries.extend(folder_entries)
+
+PLAN_STRATEGY_LABELS = {
+    'template': "目标格式",
+    'movie': "电影文件名",
+    'episode': "视频集数",
+    'crc32': "视频CRC32",
+    'duration': "视频时长",
+    'library': "媒体库",
+}
+# Plans up to this size are listed in full; larger ones get a summary and a pager.
+PLAN_REVIEW_FULL_LIMIT = 200
+PLAN_REVIEW_PAGE_SIZE = 20
+PLAN_REVIEW_TOP_FOLDERS = 10
+
+def _print_plan_entries(entries):
+    """Lists planned files grouped by folder."""
     current_dir = None
-    for old_path, new_name in rename_plan:
-        file_dir = os.path.dirname(old_path)
+    for entry in entries:
+        file_dir = entry.folder
         if file_dir != current_dir:
             if current_dir is not None:
                 print("") # Spacing between groups
             print(f"路径: {file_dir}")
             current_dir = file_dir
         
-        print(f"原: {os.path.basename(old_path)}")
-        print(f"    现 →: {new_name}\n")
-
+        print(f"原: {entry.basename}")
+        if entry.target_dir not in (None, file_dir):
+            print(f"    现 →: {os.path.join(os.path.relpath(entry.target_dir, file_dir), entry.new_name)}\n")
+        else:
+            print(f"    现 →: {entry.new_name}\n")
+
+def get_plan_summary(rename_plan):
+    """Lines counting the planned files per folder, language and naming strategy."""
+    folder_counts = collections.Counter(entry.folder for entry in rename_plan)
+    lang_counts = collections.Counter(entry.lang for entry in rename_plan)
+    strategy_counts = collections.Counter(entry.strategy for entry in rename_plan)
+
+    lines = [f"将在 {len(folder_counts)} 个文件夹中生成 {len(rename_plan)} 个文件。"]
+    lines.append("\n按文件夹:")
+    for folder, count in folder_counts.most_common(PLAN_REVIEW_TOP_FOLDERS):
+        lines.append(f"  {count:>7}  {folder}")
+    if len(folder_counts) > PLAN_REVIEW_TOP_FOLDERS:
+        lines.append(f"  ... 以及其他 {len(folder_counts) - PLAN_REVIEW_TOP_FOLDERS} 个文件夹")
+    lines.append("\n按语言: " + ", ".join(f"{lang} {count}" for lang, count in sorted(lang_counts.items())))
+    lines.append("按命名方式: " + ", ".join(f"{PLAN_STRATEGY_LABELS.get(strategy, strategy)} {count}"
+                                     for strategy, count in strategy_counts.most_common()))
+    return lines
+
+def print_plan_summary(rename_plan):
+    print('\n'.join(get_plan_summary(rename_plan)))
+
+def review_plan(rename_plan):
+    """
+    Shows the sorted plan and asks for confirmation. Returns True to go ahead.
+    Large plans are shown as a summary plus a pager that only renders the visible page.
+    """
+    set_ui_pane('plan', [line.lstrip('\n') for line in get_plan_summary(rename_plan)])
+    print("字幕文件将按照以下格式重命名，请确认：")
     print("=" * 60)
-    if input("按回车键继续，或输入其他任意键取消：") != "":
-        print(f"\n{COLOR_RED}用户取消操作{COLOR_RESET}")
+    if len(rename_plan) <= PLAN_REVIEW_FULL_LIMIT:
+        _print_plan_entries(rename_plan)
+        print("=" * 60)
+        return read_line("按回车键继续，或输入其他任意键取消：") == ""
+
+    print_plan_summary(rename_plan)
+    view = rename_plan # The full plan, or the entries matching the last search
+    page = None
+    while True:
+        print("=" * 60)
+        if page is not None:
+            page_count = max(1, -(-len(view) // PLAN_REVIEW_PAGE_SIZE))
+            start = page * PLAN_REVIEW_PAGE_SIZE
+            _print_plan_entries(view[start:start + PLAN_REVIEW_PAGE_SIZE])
+            print(f"第 {page + 1}/{page_count} 页（共 {len(view)} 个文件）")
+        print("命令: n = 下一页, p = 上一页, g <页码> = 跳转到指定页, /<文字> = 搜索, / = 显示全部, s = 汇总")
+        command = read_line("按回车键继续，或输入命令（输入其他内容将取消）：").strip()
+        if command == "":
+            return True
+
+        page_count = max(1, -(-len(view) // PLAN_REVIEW_PAGE_SIZE))
+        if command.lower() == 'n':
+            page = 0 if page is None else min(page + 1, page_count - 1)
+        elif command.lower() == 'p':
+            page = 0 if page is None else max(page - 1, 0)
+        elif command.lower().startswith('g ') and command[2:].strip().isdigit():
+            page = min(max(int(command[2:].strip()) - 1, 0), page_count - 1)
+        elif command.startswith('/'):
+            query = command[1:].strip().casefold()
+            view = [entry for entry in rename_plan
+                    if query in entry.old_path.casefold() or query in entry.new_name.casefold()] if query else rename_plan
+            if not view:
+                print(f"{COLOR_RED}没有与 '{command[1:].strip()}' 匹配的文件。{COLOR_RESET}")
+                view = rename_plan
+            page = 0
+        elif command.lower() == 's':
+            print_plan_summary(rename_plan)
+            page = None
+        else:
+            return False
+
+def execute_rename_plan(rename_plan):
+    """
+    Executes the rename plan and returns a list of target directories.
+    Entries with a target_dir (library mode) go to that folder, and a plan of only
+    such entries skips the save location question.
+    """
+    if not rename_plan:
+        logger.error("未执行重命名", extra={'blank_line': True})
+        return None, 1
+        
+    # Sort by directory first, then by new filename naturally
+    rename_plan.sort()
+    if _event_stream:
+        for entry in rename_plan:
+            emit_event('plan_entry', source=entry.old_path, name=entry.new_name, lang=entry.lang, strategy=entry.strategy,
+                       target_dir=entry.target_dir)
+
+    clear_screen()
+    if not review_plan(rename_plan):
+        logger.warning("用户取消操作", extra={'blank_line': True})
         return None, 1
     
-    location_choice = ask_with_preset("PRESET_SAVE_LOCATION", "您想将字幕文件保存在哪个位置？", {1: "新建 'sub' 文件夹保存", 2: "在原字幕文件夹保存"})
+    if all(entry.target_dir_index is not None for entry in rename_plan):
+        location_choice = 2
+    else:
+        location_choice = ask_with_preset("PRESET_SAVE_LOCATION", "您想将字幕文件保存在哪个位置？", {1: "新建 'sub' 文件夹保存", 2: "在原字幕文件夹保存"})
     
     print("\n正在处理文件...")
+    stage = EventStage('copy', files=len(rename_plan))
     count = 0
+    copied_bytes = 0
+    converted_count = 0
     # Track used directories for report and subsequent font processing
     used_directories = set()
 
-    for old_path, new_name in rename_plan:
+    for entry in rename_plan:
+        old_path = entry.old_path
         try:
             # Determine target directory relative to the *source file*
-            source_dir = os.path.dirname(old_path)
-            if location_choice == 1: # Sub folder
+            source_dir = entry.folder
+            if entry.target_dir_index is not None:
+                target_dir = entry.target_dir
+            elif location_choice == 1: # Sub folder
                 target_dir = os.path.join(source_dir, 'sub')
             else:
                 target_dir = source_dir
@@ -726,32 +3393,51 @@ def execute_rename_plan(rename_plan):
             os.makedirs(target_dir, exist_ok=True)
             used_directories.add(target_dir)
 
-            shutil.copy2(old_path, os.path.join(target_dir, new_name))
+            new_path = os.path.join(target_dir, entry.new_name)
+            converted = copy_subtitle(old_path, new_path)
+            if _run_metrics:
+                copied_bytes += os.path.getsize(new_path)
+            if converted:
+                converted_count += 1
+                log_file_event('copy', logging.INFO, "已复制 '%s' → '%s'（已转换为 UTF-8）", old_path, new_path,
+                               source=old_path, target=new_path, converted=True)
+            else:
+                log_file_event('copy', logging.INFO, "已复制 '%s' → '%s'", old_path, new_path, source=old_path, target=new_path)
             count += 1
         except Exception as e:
-            print(f"{COLOR_RED}在复制 '{os.path.basename(old_path)}' 时出错: {e}{COLOR_RESET}")
+            log_file_event('copy', logging.ERROR, "在复制 '%s' 时出错: %s", os.path.basename(old_path), e, source=old_path, error=str(e))
+        report_progress(count, len(rename_plan), "Copying")
+    stage.finish(done=count, failed=len(rename_plan) - count, converted=converted_count)
+    count_metric('subrename_files_renamed_total', count)
+    count_metric('subrename_bytes_copied_total', copied_bytes)
     
-    print(f"\n{COLOR_GREEN}已成功在 '{os.path.abspath(target_dir)} 中创建 {count} 个新文件'.{COLOR_RESET}")
+    logger.log(LOG_SUCCESS, "已成功创建 %d 个新文件", count, extra={'blank_line': True})
+    if converted_count:
+        logger.log(LOG_SUCCESS, "已将 %d 个文件转换为 UTF-8 编码", converted_count)
 
     delete_choice = 1
     if count > 0:
         delete_choice = ask_with_preset("PRESET_DELETE_ORIGINALS", "是否删除原文件？", {1: "否", 2: "是"})
         if delete_choice == 2:
             print("\n正在删除原文件...")
+            stage = EventStage('delete', files=len(rename_plan))
             deleted_count = 0
-            for old_path, _ in rename_plan:
+            for entry in rename_plan:
+                old_path = entry.old_path
                 try:
                     os.remove(old_path)
                     deleted_count += 1
+                    log_file_event('delete', logging.INFO, "已删除 '%s'", old_path, source=old_path)
                 except Exception as e:
-                    print(f"{COLOR_RED}删除 '{os.path.basename(old_path)}' 时出错: {e}{COLOR_RESET}")
-            print(f"{COLOR_GREEN}成功删除 {deleted_count} 个原文件{COLOR_RESET}")
+                    log_file_event('delete', logging.ERROR, "删除 '%s' 时出错: %s", os.path.basename(old_path), e, source=old_path, error=str(e))
+                report_progress(deleted_count, len(rename_plan), "Deleting")
+            stage.finish(done=deleted_count, failed=len(rename_plan) - deleted_count)
+            logger.log(LOG_SUCCESS, "成功删除 %d 个原文件", deleted_count)
     
     return location_choice, delete_choice
 
-def handle_unprocessed_files(all_files, processed_files, location_choice, delete_choice):
-    processed_set = set(processed_files)
-    unprocessed_files = [path for path in all_files if path not in processed_set]
+def handle_unprocessed_files(all_files, rename_plan, location_choice, delete_choice):
+    unprocessed_files = [path for path in all_files if path not in rename_plan]
 
     if not unprocessed_files:
         return
@@ -775,6 +3461,7 @@ def handle_unprocessed_files(all_files, processed_files, location_choice, delete
         )
         if handle_fonts_choice == 1:
             print(f"\n正在 {action_verb} 字体文件...")
+            stage = EventStage('fonts', files=len(font_files), move=delete_choice == 2)
             font_count = 0
             for path in font_files:
                 try:
@@ -809,9 +3496,14 @@ def handle_unprocessed_files(all_files, processed_files, location_choice, delete
                     else: # It's a file
                         action(path, os.path.join(target_dir, os.path.basename(path)))
                         font_count += 1
+                    log_file_event('fonts', logging.INFO, "%s字体 '%s' → '%s'", action_verb, path, target_dir,
+                                   source=path, target=target_dir)
                 except Exception as e:
-                    print(f"{COLOR_RED}在处理字体 '{os.path.basename(path)}' 时出错: {e}{COLOR_RESET}")
-            print(f"{COLOR_GREEN}成功处理 {font_count} 个字体{COLOR_RESET}")
+                    log_file_event('fonts', logging.ERROR, "在处理字体 '%s' 时出错: %s", os.path.basename(path), e,
+                                   source=path, error=str(e))
+            stage.finish(done=font_count, failed=len(font_files) - font_count)
+            count_metric('subrename_fonts_processed_total', font_count)
+            logger.log(LOG_SUCCESS, "成功处理 %d 个字体", font_count)
 
 
     if other_unprocessed:
@@ -822,10 +3514,11 @@ def handle_unprocessed_files(all_files, processed_files, location_choice, delete
         )
         if archive_choice == 1:
             print(f"\n正在 {action_verb} 未处理的字幕文件...")
+            stage = EventStage('archive', files=len(other_unprocessed), move=delete_choice == 2)
             archived_count = 0
             for path in other_unprocessed:
                 filename = os.path.basename(path)
-                lang = get_language_from_filename(filename)
+                lang = get_file_language(path)
                 if lang == "default":
                     lang = "misc"
                 
@@ -841,79 +3534,422 @@ def handle_unprocessed_files(all_files, processed_files, location_choice, delete
                 try:
                     action(path, os.path.join(target_dir, filename))
                     archived_count += 1
+                    log_file_event('archive', logging.INFO, "%s '%s' → '%s'", action_verb, path, target_dir,
+                                   source=path, target=target_dir)
                 except Exception as e:
-                    print(f"{COLOR_RED}在处理 '{filename}' 时出错: {e}{COLOR_RESET}")
-            print(f"{COLOR_GREEN}成功归档 {archived_count} 个未处理的字幕文件{COLOR_RESET}")
+                    log_file_event('archive', logging.ERROR, "在处理 '%s' 时出错: %s", filename, e, source=path, error=str(e))
+            stage.finish(done=archived_count, failed=len(other_unprocessed) - archived_count)
+            logger.log(LOG_SUCCESS, "成功归档 %d 个未处理的字幕文件", archived_count)
+
+# --- Series profiles ---
+PROFILE_STORE_PATH = os.path.join(os.path.expanduser('~'), '.subrename', 'profiles.json')
+# Preset answers stored in a profile and replayed through CONFIG.
+PROFILE_PRESET_KEYS = ("PRESET_ADD_SUFFIX", "PRESET_SAVE_LOCATION", "PRESET_DELETE_ORIGINALS",
+                       "PRESET_ARCHIVE_UNPROCESSED", "PRESET_HANDLE_FONTS")
+
+_profile_store = None
+
+def load_profile_store():
+    """All saved series profiles (profile key -> profile), read once per session."""
+    global _profile_store
+    if _profile_store is None:
+        try:
+            with open(PROFILE_STORE_PATH, encoding='utf-8') as f:
+                _profile_store = json.load(f)
+        except FileNotFoundError:
+            _profile_store = {}
+        except (OSError, ValueError) as e:
+            print(f"{COLOR_RED}警告：无法读取系列配置 '{PROFILE_STORE_PATH}': {e}{COLOR_RESET}")
+            _profile_store = {}
+        if not isinstance(_profile_store, dict):
+            _profile_store = {}
+    return _profile_store
+
+def save_profile_store():
+    """Writes the profile store to a temporary file first, so an interrupted save never truncates it."""
+    temp_path = PROFILE_STORE_PATH + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(PROFILE_STORE_PATH), exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(load_profile_store(), f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(temp_path, PROFILE_STORE_PATH)
+    except OSError as e:
+        print(f"{COLOR_RED}警告：无法保存系列配置到 '{PROFILE_STORE_PATH}': {e}{COLOR_RESET}")
+
+def get_series_profile_key(paths):
+    """
+    (title, key) for a batch of subtitles: the most common series title among the files and
+    the folder that holds them, or (None, None) if no title can be found.
+    """
+    files = [p for p in paths if os.path.isfile(p)]
+    title_counts = {}
+    for path in files:
+        title = normalize_title(os.path.basename(path))
+        if title:
+            title_counts[title] = title_counts.get(title, 0) + 1
+    if not title_counts:
+        return None, None
+    title = max(sorted(title_counts), key=title_counts.get)
+    source_dirs = [os.path.dirname(os.path.abspath(p)) for p in files]
+    try:
+        source_dir = os.path.commonpath(source_dirs)
+    except ValueError:
+        # Files on different drives.
+        source_dir = source_dirs[0]
+    return title, f"{title}|{os.path.normcase(source_dir)}"
+
+def find_series_profile(paths):
+    """(key, profile) for a batch; profile is None for a new series, key is None if profiles are off."""
+    if CONFIG.get("USE_SERIES_PROFILES") != 1:
+        return None, None
+    title, key = get_series_profile_key(paths)
+    if key is None:
+        return None, None
+    profile = load_profile_store().get(key)
+    if profile:
+        print(f"\n找到系列 '{title}' 的配置：沿用上次的选择。")
+    return key, profile
+
+def profile_config(profile):
+    """CONFIG overrides that replay the answers stored in a profile."""
+    if not profile:
+        return {}
+    overrides = {key: profile[key] for key in PROFILE_PRESET_KEYS if profile.get(key) is not None}
+    if profile.get("language") not in (None, "default"):
+        overrides["PRESET_LANGUAGE"] = [profile["language"]]
+    return overrides
+
+def get_profile_videos(profile):
+    """Video files in the folders an sp-mode profile used last time, or None to ask again."""
+    video_dirs = [d for d in profile.get("sp_video_dirs") or [] if os.path.isdir(d)]
+    if not video_dirs:
+        return None
+    print(f"找到配置：使用以下文件夹中的视频 {', '.join(video_dirs)}")
+    # The folders may also hold subtitles, e.g. from an earlier "same folder" run.
+    return [p for p in expand_paths(video_dirs, recursive=False) if os.path.splitext(p)[1].lower() in VIDEO_EXTENSIONS] or None
+
+def save_series_profile(key, lang_choice, add_suffix, target_format, is_movie_mode):
+    """Records the choices of a finished batch under its profile key."""
+    profile = {preset_key: _session_choices[preset_key] for preset_key in PROFILE_PRESET_KEYS if preset_key in _session_choices}
+    profile["PRESET_ADD_SUFFIX"] = 2 if add_suffix else 1
+    profile["language"] = lang_choice
+    profile["target_format"] = target_format
+    profile["movie_mode"] = bool(is_movie_mode)
+    if target_format == 'sp':
+        profile["sp_video_dirs"] = _session_choices.get("SP_VIDEO_DIRS", [])
+    else:
+        template = TargetTemplate.compile(target_format, add_suffix, is_movie_mode)
+        if template:
+            profile["template"] = template.to_dict()
+    load_profile_store()[key] = profile
+    save_profile_store()
+
+# --- Library mode ---
+VIDEO_EXTENSIONS = {'.mkv', '.mp4', '.m4v', '.mov', '.avi', '.wmv', '.flv', '.webm', '.ts', '.m2ts', '.rmvb'}
+LIBRARY_SUBTITLE_EXTENSIONS = {'.ass', '.ssa', '.srt', '.vtt', '.sup', '.smi'}
+# How many unpaired subtitles are listed by name after a library scan.
+LIBRARY_MAX_LISTED_UNPAIRED = 20
+
+def get_season_number(path):
+    """Season number from 'S02E05' in the filename or a 'Season 2'/'S2'/'第2季' folder. Defaults to 1."""
+    match = re.search(r'(?i)S(\d{1,2})E\d', os.path.basename(path))
+    if match:
+        return int(match.group(1))
+    for part in reversed(os.path.dirname(path).replace('\\', '/').split('/')):
+        match = re.match(r'(?i)^(?:season|series|s)\s*(\d{1,2})$|^第(\d{1,2})季$', part.strip())
+        if match:
+            return int(match.group(1) or match.group(2))
+    return 1
+
+def _is_synced_copy(sub_path, v_path):
+    """Whether a subtitle sits next to the video under the video's name (Show 01.ass, Show 01.chs.ass)."""
+    sub_dir, sub_name = os.path.split(os.path.normcase(sub_path))
+    v_dir, v_name = os.path.split(os.path.normcase(v_path))
+    sub_stem, v_stem = os.path.splitext(sub_name)[0], os.path.splitext(v_name)[0]
+    return sub_dir == v_dir and (sub_stem == v_stem or sub_stem.rpartition('.')[0] == v_stem)
+
+def build_library_plan(root):
+    """
+    Indexes every video and subtitle under `root` in one scan and pairs each subtitle with
+    a video of the same season and episode, looking in the subtitle's own folder first and
+    then in its parent, sibling and child folders. Returns a RenamePlan whose entries
+    carry the video's folder as their target_dir.
+    """
+    videos, subtitles = [], []
+    for path in expand_paths([root], recursive=True):
+        ext = os.path.splitext(path)[1].lower()
+        if ext in VIDEO_EXTENSIONS:
+            videos.append(path)
+        elif ext in LIBRARY_SUBTITLE_EXTENSIONS:
+            subtitles.append(path)
+    print(f"\n找到 {len(videos)} 个视频文件和 {len(subtitles)} 个字幕文件")
+
+    # Video index: folder -> [(season, episode key, series title, path)], plus a title index
+    # for subtitles kept in a separate tree.
+    videos_by_dir = {}
+    videos_by_series = {}
+    child_dirs = {}
+    series_index = TrigramIndex()
+    for v_path, inferred_id in zip(videos, infer_episode_identifiers(videos)):
+        v_filename = os.path.basename(v_path)
+        episode_id = inferred_id or extract_episode_identifier(v_filename) or probe_video_container(v_path).get('episode')
+        # The season is compared separately (from the name or the folder).
+        entry = (get_season_number(v_path), episode_id and episode_id.without_season(), normalize_title(v_filename), v_path)
+        v_dir = os.path.dirname(v_path)
+        if v_dir not in videos_by_dir:
+            videos_by_dir[v_dir] = []
+            child_dirs.setdefault(os.path.dirname(v_dir), []).append(v_dir)
+        videos_by_dir[v_dir].append(entry)
+        videos_by_series.setdefault(entry[2], []).append(entry)
+        series_index.add(entry[2])
+
+    preset_lang = CONFIG.get("PRESET_LANGUAGE")
+    wanted_langs = None
+    if isinstance(preset_lang, list) and 'all' not in [l.lower() for l in preset_lang]:
+        wanted_langs = {l.lower() for l in preset_lang}
+
+    pairs = {} # video path -> [(subtitle path, lang)]
+    unpaired = []
+    infer_episode_identifiers(subtitles)
+    for sub_path in sorted(subtitles, key=natural_sort_key):
+        lang = get_file_language(sub_path)
+        if wanted_langs is not None and lang not in wanted_langs and lang != "default":
+            continue
+        sub_dir = os.path.dirname(sub_path)
+        parent_dir = os.path.dirname(sub_dir)
+        nearby_dirs = [parent_dir] + child_dirs.get(parent_dir, []) + child_dirs.get(sub_dir, [])
+        series = normalize_title(os.path.basename(sub_path))
+        best_series = series_index.best_match(series) if series else None
+        tiers = [videos_by_dir.get(sub_dir, []),
+                 [v for d in nearby_dirs if d != sub_dir for v in videos_by_dir.get(d, [])],
+                 videos_by_series.get(best_series, [])]
+
+        episode_id = identify_episode(sub_path)
+        episode_id = episode_id and episode_id.without_season()
+        season = get_season_number(sub_path)
+        video = None
+        for tier, candidates in enumerate(tiers):
+            if episode_id is None:
+                if tier == 2:
+                    break # Unnumbered files are only paired within their own folders.
+                # Movie folder: an unnumbered subtitle next to exactly one video.
+                matches = [v for v in candidates if v[1] is None]
+            else:
+                matches = [v for v in candidates if v[0] == season and v[1] == episode_id]
+            if len(matches) == 1:
+                video = matches[0][3]
+            elif matches:
+                # Several series share the folder: take the closest title.
+                video = pick_by_title([(v[2], v[3]) for v in matches], series, series_index)
+            if matches:
+                break
+        if video:
+            pairs.setdefault(video, []).append((sub_path, lang))
+        else:
+            unpaired.append(sub_path)
+
+    rename_plan = RenamePlan()
+    in_place = 0
+    for v_path, subs in pairs.items():
+        # Copies an earlier sync wrote next to the video are its results, not new sources.
+        synced = [(sub_path, lang) for sub_path, lang in subs if _is_synced_copy(sub_path, v_path)]
+        sources = [entry for entry in subs if entry not in synced]
+        if not sources:
+            in_place += len(synced)
+        used_names = set()
+        for sub_path, lang in sources:
+            # Several subtitles for one video need their language suffix to stay apart.
+            add_suffix = lang != "default" and (len(sources) > 1 or CONFIG.get("PRESET_ADD_SUFFIX") == 2)
+            new_name = _video_based_filename(v_path, sub_path, lang, add_suffix)
+            target_path = os.path.join(os.path.dirname(v_path), new_name)
+            if new_name.lower() in used_names:
+                unpaired.append(sub_path)
+                continue
+            used_names.add(new_name.lower())
+            if os.path.exists(target_path):
+                in_place += 1 # Synced by an earlier run
+                continue
+            rename_plan.add(sub_path, new_name, lang, 'library', target_dir=os.path.dirname(v_path))
+
+    print(f"已匹配 {len(rename_plan) + in_place} 个字幕（其中 {in_place} 个已存在），{len(unpaired)} 个未匹配")
+    if unpaired:
+        print(f"{COLOR_RED}以下字幕未能匹配到视频文件：{COLOR_RESET}")
+        for path in unpaired[:LIBRARY_MAX_LISTED_UNPAIRED]:
+            print(f"{COLOR_RED}- {path}{COLOR_RESET}")
+        if len(unpaired) > LIBRARY_MAX_LISTED_UNPAIRED:
+            print(f"{COLOR_RED}... 以及其他 {len(unpaired) - LIBRARY_MAX_LISTED_UNPAIRED} 个{COLOR_RESET}")
+    return rename_plan
+
+def run_library_mode():
+    """Pairs all subtitles under one library folder with their videos and renames them in one pass."""
+    print("\n请拖入媒体库根文件夹并按回车：")
+    root = read_line().strip().strip('"\'')
+    if not os.path.isdir(root):
+        print(f"{COLOR_RED}错误：文件夹路径无效{COLOR_RESET}")
+        return
+    stage = EventStage('plan', library=root)
+    rename_plan = build_library_plan(root)
+    stage.finish(entries=len(rename_plan))
+    if not rename_plan:
+        print(f"\n{COLOR_RED}未执行重命名{COLOR_RESET}")
+        return
+    read_line("请按回车键查看重命名列表...")
+    execute_rename_plan(rename_plan)
+
+def process_batch(all_subtitle_paths):
+    """
+    Processes one batch of dropped subtitles, from language selection to unprocessed files.
+    Returns 'restart' to go straight back to the first prompt, 'exit' to quit, or None.
+    """
+    _session_choices.clear()
+    profile_key, profile = find_series_profile(all_subtitle_paths)
+    with config_overlay(profile_config(profile)):
+        files_to_process, lang_choice, is_movie_mode = group_and_select_languages(all_subtitle_paths)
+        if not files_to_process:
+            print(f"\n{COLOR_RED}在所选的语言中未找到需要处理的文件{COLOR_RESET}")
+            return None
+
+        add_suffix = ask_add_suffix(lang_choice)
+        target_format = None
+        video_paths = None
+
+        if profile and profile.get("target_format"):
+            target_format = profile["target_format"]
+            is_movie_mode = profile.get("movie_mode", False)
+            print(f"\n找到配置：使用目标格式 '{target_format}'。")
+            if target_format == 'sp':
+                video_paths = get_profile_videos(profile)
+            elif profile.get("template"):
+                # The saved template is used as is instead of locating the placeholder again.
+                template = TargetTemplate.from_dict(profile["template"])
+                if template.add_suffix == add_suffix:
+                    _target_template_cache[(target_format, add_suffix, is_movie_mode)] = template
+
+        # Check for forced SP mode preset for series
+        force_sp_preset = CONFIG.get("FORCE_SP_MODE")
+        if target_format is None and not is_movie_mode and force_sp_preset == 1:
+            print("\n找到预设: 自动进入 SP 模式（将基于每集视频文件命名，用于处理每集有不同文件名的剧集）")
+            target_format = 'sp'
+        
+        # If not forced into SP mode, proceed with normal logic
+        if target_format is None:
+            if is_movie_mode:
+                print("\n" + "-" * 50)
+                print(f"{COLOR_RED}字幕文件中未找到集数{COLOR_RESET}")
+                movie_choice = ask_with_preset(
+                    None, # This is a dynamic choice, not suitable for a simple preset
+                    "如何继续？",
+                    {
+                        1: "电影模式（根据输入的单个目标文件名进行重命名）",
+                        2: "剧集模式（尝试视为剧集，输入目标格式中需要包含数字）"
+                    }
+                )
+                if movie_choice == 1:
+                    target_format = get_target_format(True, files_to_process, add_suffix)
+                else: # Choice is 2
+                    print("\n按照剧集模式运行")
+                    is_movie_mode = False # Override detection
+                    target_format = get_target_format(False, files_to_process, add_suffix)
+            else: # Regular series mode
+                target_format = get_target_format(False, files_to_process, add_suffix)
+
+        if not target_format:
+            if read_line("\n按回车键重新开始，或输入其他任意键退出：") != "":
+                return 'exit'
+            return 'restart'
+
+        # Generate plan using the final is_movie_mode value which might have been overridden
+        stage = EventStage('plan', files=len(files_to_process), target_format=target_format)
+        rename_plan = generate_rename_plan(files_to_process, target_format, add_suffix, is_movie_mode, video_paths)
+        stage.finish(entries=len(rename_plan) if isinstance(rename_plan, RenamePlan) else 0)
+        
+        if rename_plan == 'restart':
+            return 'restart'
+
+        location_choice, delete_choice = execute_rename_plan(rename_plan)
+
+        # location_choice is None if cancelled
+        if location_choice:
+            handle_unprocessed_files(all_subtitle_paths, rename_plan, location_choice, delete_choice)
+            if profile_key:
+                save_series_profile(profile_key, lang_choice, add_suffix, target_format, is_movie_mode)
+    return None
 
 def main():
+    global _path_list
     while True:
+        # Folder settings and inferred episode ids only hold for the files of one batch.
+        _directory_configs.clear()
+        _inferred_episode_ids.clear()
         clear_screen()
         print("Subtitle Renamer (v 0.9.9)")
-        all_subtitle_paths = get_files_from_user("请拖入所有待处理字幕文件或文件夹并按回车：")
+        if _path_list:
+            # The list given on the command line replaces the prompt for the first batch only.
+            stream, null_delimited, name = _path_list
+            _path_list = None
+            all_subtitle_paths = get_files_from_list(stream, null_delimited, name, include=CONFIG.get("SCAN_INCLUDE"))
+        else:
+            all_subtitle_paths = get_files_from_user("请拖入所有待处理字幕文件或文件夹并按回车：", allow_library=True,
+                                                     include=CONFIG.get("SCAN_INCLUDE"))
         
         if all_subtitle_paths == 'restart':
             continue
         if not all_subtitle_paths: 
             break
 
-        files_to_process, lang_choice, is_movie_mode = group_and_select_languages(all_subtitle_paths)
-        if not files_to_process:
-            print(f"\n{COLOR_RED}在所选的语言中未找到需要处理的文件{COLOR_RESET}")
-        else:
-            add_suffix = ask_add_suffix(lang_choice)
-            target_format = None
-
-            # Check for forced SP mode preset for series
-            force_sp_preset = CONFIG.get("FORCE_SP_MODE")
-            if not is_movie_mode and force_sp_preset == 1:
-                print("\n找到预设: 自动进入 SP 模式（将基于每集视频文件命名，用于处理每集有不同文件名的剧集）")
-                target_format = 'sp'
-            
-            # If not forced into SP mode, proceed with normal logic
-            if target_format is None:
-                if is_movie_mode:
-                    print("\n" + "-" * 50)
-                    print(f"{COLOR_RED}字幕文件中未找到集数{COLOR_RESET}")
-                    movie_choice = ask_with_preset(
-                        None, # This is a dynamic choice, not suitable for a simple preset
-                        "如何继续？",
-                        {
-                            1: "电影模式（根据输入的单个目标文件名进行重命名）",
-                            2: "剧集模式（尝试视为剧集，输入目标格式中需要包含数字）"
-                        }
-                    )
-                    if movie_choice == 1:
-                        target_format = get_target_format(is_movie_mode=True)
-                    else: # Choice is 2
-                        print("\n按照剧集模式运行")
-                        is_movie_mode = False # Override detection
-                        target_format = get_target_format(is_movie_mode=False)
-                else: # Regular series mode
-                    target_format = get_target_format(is_movie_mode=False)
-
-            if not target_format:
-                if input("\n按回车键重新开始，或输入其他任意键退出：") != "":
-                    break
-                else:
-                    continue
-
-            # Generate plan using the final is_movie_mode value which might have been overridden
-            rename_plan = generate_rename_plan(files_to_process, target_format, add_suffix, is_movie_mode)
-            
-            if rename_plan == 'restart':
-                continue
-
-            location_choice, delete_choice = execute_rename_plan(rename_plan)
+        if all_subtitle_paths == 'library':
+            run_library_mode()
+            if read_line("\n按回车键重新开始，或输入其他任意键退出：") != "":
+                break
+            continue
 
-            # location_choice is None if cancelled
-            if location_choice:
-                processed_paths = [item[0] for item in rename_plan] if rename_plan else []
-                handle_unprocessed_files(all_subtitle_paths, processed_paths, location_choice, delete_choice)
+        # Folders with different .subrename settings are processed as separate batches.
+        partitions = partition_by_directory_config(all_subtitle_paths)
+        result = None
+        for index, (overrides, paths) in enumerate(partitions):
+            if index > 0:
+                read_line(f"\n按回车键继续处理下一组文件夹 ({index + 1}/{len(partitions)})...")
+            if overrides or len(partitions) > 1:
+                settings = ', '.join(f"{key}={value!r}" for key, value in sorted(overrides.items())) or "无"
+                print(f"\n以下 {len(paths)} 项使用文件夹设置: {settings}")
+            with config_overlay(overrides):
+                result = process_batch(paths)
+            if result in ('restart', 'exit'):
+                break
+        if result == 'restart':
+            continue
+        if result == 'exit':
+            break
 
-        if input("\n按回车键重新开始，或输入其他任意键退出：") != "":
+        if read_line("\n按回车键重新开始，或输入其他任意键退出：") != "":
             break
 
 if __name__ == "__main__":
-    if sys.platform == "win32":
-        os.system('')
-    main()
+    # Needed by the filename parsing process pool when running as a frozen executable.
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="按视频文件或命名格式重命名字幕文件。")
+    parser.add_argument('--from-list', metavar='FILE',
+                        help="从 FILE 读取第一批字幕的路径（'-' 表示标准输入），而不是询问")
+    parser.add_argument('-0', '--null', action='store_true',
+                        help="列表中的路径以 NUL 字符分隔（find -print0），而不是换行")
+    # Anything else (e.g. files dropped onto the executable) is ignored, as before.
+    args = parser.parse_known_args()[0]
+    enable_ansi_colors()
+    if args.from_list:
+        try:
+            _path_list = (open_path_list(args.from_list), args.null, args.from_list)
+        except OSError as e:
+            print(f"{COLOR_RED}无法读取路径列表 '{args.from_list}'：{e}{COLOR_RESET}")
+    load_user_config()
+    enable_log_file()
+    open_event_stream()
+    start_run_metrics()
+    try:
+        if CONFIG.get("USE_CURSES_UI") == 1 and curses and sys.stdin.isatty() and sys.stdout.isatty():
+            run_with_curses_ui(main, "Subtitle Renamer")
+        else:
+            if CONFIG.get("USE_CURSES_UI") == 1:
+                print(f"{COLOR_RED}全屏界面需要 'curses' 模块和终端环境，将使用普通控制台。{COLOR_RESET}")
+            main()
+    finally:
+        write_run_metrics()